@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import configparser
+import functools
 import json
 import os
 import re
@@ -10,13 +11,21 @@ from fastapi.responses import HTMLResponse
 from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import Response
 from topologic import read_config
-from topologic.DB import DBSearch
+from topologic.cache import ResponseCache
+from topologic.DB import AsyncDBSearch, async_connection_pool
 
 global_config = configparser.ConfigParser()
 global_config.read("/etc/topologic/global_settings.ini")
 DATABASE = global_config["DATABASE"]
 APP_PATH = global_config["WEB_APP"]["web_app_path"]
 
+FILE_CACHE = {}  # parsed config files of each table, by path
+RESPONSE_CACHE = ResponseCache(
+    max_size=global_config["WEB_APP"].getint("response_cache_size", fallback=1000),
+    ttl=global_config["WEB_APP"].getint("response_cache_ttl", fallback=3600),
+    path=global_config["WEB_APP"].get("response_cache_path", fallback="") or None,
+)
+
 TAGS = re.compile(r"<[^>]+>")
 START_TAG = re.compile(r"^[^<]*?>")
 
@@ -27,9 +36,22 @@ app.add_middleware(
 )
 
 
-def read_model_config(table_name):
+def cached_file(path, parse):
+    """Result of parse(path), parsed again only when the file changes. Rebuilding a model publishes a new
+    copy of its web app, so the resolved path of the file changes as well"""
+    real_path = os.path.realpath(path)
+    file_stat = os.stat(real_path)
+    version = (real_path, file_stat.st_ino, file_stat.st_mtime_ns)
+    cached = FILE_CACHE.get(path)
+    if cached is None or cached[0] != version:
+        cached = (version, parse(real_path))
+        FILE_CACHE[path] = cached
+    return cached[1]
+
+
+def parse_model_config(path):
     local_config = configparser.ConfigParser()
-    local_config.read(os.path.join(APP_PATH, table_name, "model_config.ini"))
+    local_config.read(path)
     return {
         "object_level": dict(
             zip(
@@ -49,9 +71,14 @@ def read_model_config(table_name):
         "metadata_fields": local_config["DATA"]["metadata"].split(","),
         "corpus_size": int(local_config["DATA"]["num_docs"]),
         "vocabularySize": local_config["DATA"]["num_tokens"],
+        "compact_arrays": local_config["DATA"].getboolean("compact_arrays", fallback=False),
     }
 
 
+def read_model_config(table_name):
+    return cached_file(os.path.join(APP_PATH, table_name, "model_config.ini"), parse_model_config)
+
+
 def group_distributions_over_time(distribution_over_time, label_map):
     grouped_evolution = defaultdict(float)
     for year, weight in zip(distribution_over_time["labels"], distribution_over_time["data"]):
@@ -60,10 +87,48 @@ def group_distributions_over_time(distribution_over_time, label_map):
     return {"labels": labels, "data": data}
 
 
-def read_json_config(path):
+def model_generation(table):
+    """Build generation of a model: the web app directory its path points to, which changes at each rebuild"""
+    return os.path.realpath(os.path.join(APP_PATH, table))
+
+
+def cached_response(endpoint):
+    """Cache the responses of an async endpoint by table, build generation of its model and parameters"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        async def cached_endpoint(**params):
+            key = ResponseCache.key(params["table"], model_generation(params["table"]), endpoint, params)
+            response = await RESPONSE_CACHE.get(key)
+            if response is None:
+                response = await function(**params)
+                await RESPONSE_CACHE.set(key, response)
+            return response
+
+        return cached_endpoint
+
+    return decorator
+
+
+async def model_search(table, object_level, config):
+    """Async queries of a model's tables, run on the connection pool of the worker"""
+    return AsyncDBSearch(await async_connection_pool(DATABASE), table, object_level, config["compact_arrays"])
+
+
+def parse_json(path):
     with open(path) as input_file:
-        config = json.load(input_file)
-    return config
+        return json.load(input_file)
+
+
+def read_json_config(path):
+    return cached_file(path, parse_json)
+
+
+@app.get("/pool_stats")
+async def pool_stats():
+    """Connection pool metrics of the worker process serving the request"""
+    pool = await async_connection_pool(DATABASE)
+    return {"pid": os.getpid(), **pool.stats(), "response_cache": RESPONSE_CACHE.stats()}
 
 
 @app.get("/{table_name}")
@@ -99,7 +164,7 @@ def get_js(table_name: str, js_file: str):
 @app.get("/get_config/{table}")
 def get_config(table, full_config: bool = False):
     if full_config is True:
-        config = read_model_config(table)
+        config = dict(read_model_config(table))  # copy, the cached config is shared between requests
         config["topics_words"] = read_json_config(os.path.join(APP_PATH, table, "topic_words.json"))
         config["appConfig"] = read_json_config(os.path.join(APP_PATH, table, "appConfig.json"))
         return config
@@ -108,10 +173,7 @@ def get_config(table, full_config: bool = False):
 
 @app.get("/get_topic_words/{table_name}")
 def get_topic_words(table_name: str):
-    path = os.path.join(APP_PATH, table_name, "topic_words.json")
-    with open(path) as input_file:
-        topic_words = json.load(input_file)
-    return topic_words
+    return read_json_config(os.path.join(APP_PATH, table_name, "topic_words.json"))
 
 
 @app.get("/get_topic_ids")
@@ -121,28 +183,27 @@ def get_topic_ids(table: str):
 
 
 @app.get("/get_topic_data/{table}/{topic_id}")
-def get_topic_data(table, topic_id):
+@cached_response("get_topic_data")
+async def get_topic_data(table, topic_id, similar_topics: int = 10):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"])
-    topic_data = db.get_topic_data(int(topic_id), config["metadata_fields"])
+    db = await model_search(table, config["object_level"], config)
+    topic_data = await db.get_topic_data(int(topic_id), config["metadata_fields"], similar_topics)
     return topic_data
 
 
 @app.get("/get_docs_in_topic_by_year/{table}/{topic_id}/{year}")
-def get_docs_in_topic_by_year(table, topic_id, year):
+async def get_docs_in_topic_by_year(table, topic_id, year):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"])
-    documents = db.get_topic_data_by_year(
-        int(topic_id), year, config["topic_over_time_interval"], config["metadata_fields"], 50,
-    )
+    db = await model_search(table, config["object_level"], config)
+    documents = await db.get_topic_data_by_year(int(topic_id), year, config["metadata_fields"], 50)
     return documents
 
 
 @app.get("/get_doc_data/{table}/{philo_db}")
-def get_doc_data(table, philo_db, philo_id):
+async def get_doc_data(table, philo_db, philo_id):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"][philo_db])
-    doc_data = db.get_doc_data(philo_id, philo_db)
+    db = await model_search(table, config["object_level"][philo_db], config)
+    doc_data = await db.get_doc_data(philo_id, philo_db)
     if doc_data is None:
         return {
             "topic_distribution": None,
@@ -151,6 +212,8 @@ def get_doc_data(table, philo_db, philo_id):
             "topic_sim_docs": None,
             "words": None,
         }
+    similar_doc_ids = [doc_id for doc_id, _ in doc_data["topic_similarity"] + doc_data["vector_similarity"]]
+    similar_docs_metadata = await db.get_metadata_for_docs(similar_doc_ids, config["metadata_fields"])
     word_list = [(w[0], w[1] * 10, w[2]) for w in doc_data["word_list"][:50] if w[1] > 0]
     highest_value = word_list[0][1]
     if len(word_list) > 1:
@@ -187,14 +250,14 @@ def get_doc_data(table, philo_db, philo_id):
     weighted_word_list = [(w[0], w[1] / 10, w[2], color_codes[w[1]]) for w in adjusted_word_list]
     weighted_word_list.sort(key=lambda x: x[0])
 
-    topic_similarity = []
-    for doc_id, score in doc_data["topic_similarity"]:
-        doc_metadata = db.get_metadata(doc_id, config["metadata_fields"])
-        topic_similarity.append({"doc_id": doc_id, "metadata": doc_metadata, "score": score})
-    vector_similarity = []
-    for doc_id, score in doc_data["vector_similarity"]:
-        doc_metadata = db.get_metadata(doc_id, config["metadata_fields"])
-        vector_similarity.append({"doc_id": doc_id, "metadata": doc_metadata, "score": score})
+    topic_similarity = [
+        {"doc_id": doc_id, "metadata": similar_docs_metadata[doc_id], "score": score}
+        for doc_id, score in doc_data["topic_similarity"]
+    ]
+    vector_similarity = [
+        {"doc_id": doc_id, "metadata": similar_docs_metadata[doc_id], "score": score}
+        for doc_id, score in doc_data["vector_similarity"]
+    ]
 
     metadata = {field: doc_data[field] for field in config["metadata_fields"]}
 
@@ -208,10 +271,11 @@ def get_doc_data(table, philo_db, philo_id):
 
 
 @app.get("/get_word_data/{table}/{word}")
-def get_word_data(table, word, word_limit=20):
+@cached_response("get_word_data")
+async def get_word_data(table, word, word_limit=20):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"])
-    word_data = db.get_word_data(word)
+    db = await model_search(table, config["object_level"], config)
+    word_data = await db.get_word_data(word)
     if word_data is None:
         return {
             "word": word,
@@ -222,44 +286,66 @@ def get_word_data(table, word, word_limit=20):
             "similar_words_by_topic": None,
             "similar_words_by_cooc": None,
         }
-    sorted_docs = word_data["docs"]
-    documents = []
-    for document_id, score in sorted_docs[:50]:
-        metadata = db.get_metadata(document_id, config["metadata_fields"])
-        documents.append({"metadata": metadata, "doc_id": document_id, "score": score})
+    sorted_docs = word_data["docs"][:50]
+    doc_ids = [document_id for document_id, _ in sorted_docs]
+    metadata = await db.get_metadata_for_docs(doc_ids, config["metadata_fields"])
+    documents = [
+        {"metadata": metadata[document_id], "doc_id": document_id, "score": score} for document_id, score in sorted_docs
+    ]
     return {
         "word": word,
         "word_id": word_data["word_id"],
         "topic_ids": list(range(config["topics"])),
         "topic_distribution": word_data["distribution_across_topics"],
         "documents": documents[:100],
-        "similar_words_by_topic": word_data["similar_words_by_topic"][1 : word_limit + 1],
-        "similar_words_by_cooc": word_data["similar_words_by_cooc"][1 : word_limit + 1],
+        "similar_words_by_topic": word_data["similar_words_by_topic"][:word_limit],
+        "similar_words_by_cooc": word_data["similar_words_by_cooc"][:word_limit],
+    }
+
+
+@app.get("/get_word_docs/{table}/{word}")
+async def get_word_docs(table, word, start: int = 0, limit: int = 50):
+    config = read_model_config(table)
+    db = await model_search(table, config["object_level"], config)
+    word_docs = await db.get_word_docs(word, start, limit)
+    doc_ids = [document_id for document_id, _ in word_docs]
+    metadata = await db.get_metadata_for_docs(doc_ids, config["metadata_fields"])
+    documents = [
+        {"metadata": metadata[document_id], "doc_id": document_id, "score": score} for document_id, score in word_docs
+    ]
+    return {
+        "word": word,
+        "documents": documents,
+        "start": start,
+        "next": start + limit if len(documents) == limit else None,
     }
 
 
 @app.get("/get_all_field_values/{table}")
-def get_all_field_values(table, field: str, filter: int = None):
+@cached_response("get_all_field_values")
+async def get_all_field_values(table, field: str, filter: int = None):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"])
+    db = await model_search(table, config["object_level"], config)
     if field == "word":
-        field_values = db.get_vocabulary()
+        field_values = await db.get_vocabulary()
     else:
-        field_values = db.get_all_metadata_values(field, frequency_filter=filter)
+        field_values = await db.get_all_metadata_values(field, frequency_filter=filter)
     return {"field_values": field_values, "size": len(field_values)}
 
 
 @app.get("/get_field_distribution/{table}/{field}")
-def get_field_distribution(table, field, value: str):
+@cached_response("get_field_distribution")
+async def get_field_distribution(table, field, value: str):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"])
-    topic_distribution = db.get_topic_distribution_by_metadata(field, value)
+    db = await model_search(table, config["object_level"], config)
+    topic_distribution = await db.get_topic_distribution_by_metadata(field, value)
     return {"topic_distribution": topic_distribution}
 
 
 @app.get("/get_time_distributions/{table}/")
-def get_time_distributions(table):
+@cached_response("get_time_distributions")
+async def get_time_distributions(table):
     config = read_model_config(table)
-    db = DBSearch(DATABASE, table, config["object_level"])
-    distributions_over_time = db.get_topic_distributions_over_time()
+    db = await model_search(table, config["object_level"], config)
+    distributions_over_time = await db.get_topic_distributions_over_time()
     return {"distributions_over_time": distributions_over_time}
@@ -24,6 +24,7 @@ setup(
         "httptools",
         "annoy",
         "psycopg2",
+        "asyncpg",
         "multiprocess",
         "text_preprocessing @ git+https://github.com/ARTFL-Project/text-preprocessing@v1.1#egg=text_preprocessing",
         "philologic>=4.7.4.4",
@@ -1,20 +1,260 @@
 #!/usr/bin/env python3
 
+import asyncio
+import atexit
+import contextlib
+import io
 import json
+import os
+import shutil
+import tempfile
+import time
 from collections import Counter
-from itertools import repeat
-from math import log
 
+import asyncpg
 import numpy as np
 import psycopg2
 from multiprocess import Pool, cpu_count
-from psycopg2.extras import RealDictCursor
-from sklearn.metrics import pairwise_distances
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
 from topologic import year_normalizer
+from topologic.topic_model import top_k_columns
 from tqdm import tqdm, trange
 
 OBJECT_LEVELS = {"doc": 1, "div1": 2, "div2": 3, "para": 4, "sent": 5}
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_value(value):
+    """Format a value for PostgreSQL's COPY text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bytes):
+        return f"\\\\x{value.hex()}"
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_line(row):
+    """Format a row as a line of PostgreSQL's COPY text format"""
+    return "\t".join(copy_value(value) for value in row) + "\n"
+
+
+def copy_lines(row_format, *columns):
+    """Format numeric columns as lines of PostgreSQL's COPY text format, applying row_format (the %-format
+    of one line, with %r for floats) to the whole block at once"""
+    values = np.empty(len(columns[0]) * len(columns), dtype=object)
+    for position, column in enumerate(columns):
+        values[position :: len(columns)] = column.tolist()
+    return (row_format * len(columns[0])) % tuple(values)
+
+
+def pack_array(values):
+    """Pack a vector of weights as little-endian float32 bytes"""
+    return np.asarray(values, dtype="<f4").tobytes()
+
+
+class CopyLoader:
+    """Stream rows into a table with COPY ... FROM STDIN, sending them in batches of at most batch_size rows or,
+    for tables with large rows, of about max_batch_bytes characters"""
+
+    def __init__(self, cursor, table, columns, batch_size=10000, max_batch_bytes=67108864):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.buffer = io.StringIO()
+        self.pending_rows = 0
+        self.rows = 0
+        self.start_time = time.time()
+
+    def add(self, row):
+        self.add_lines(copy_line(row), 1)
+
+    def add_lines(self, lines, row_count):
+        """Add row_count rows already formatted with copy_line or copy_lines"""
+        self.buffer.write(lines)
+        self.pending_rows += row_count
+        if self.pending_rows >= self.batch_size or self.buffer.tell() >= self.max_batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+        self.buffer.seek(0)
+        self.cursor.copy_expert(f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN", self.buffer)
+        self.rows += self.pending_rows
+        self.pending_rows = 0
+        self.buffer = io.StringIO()
+
+    def close(self):
+        self.flush()
+        elapsed = time.time() - self.start_time
+        print(f"Loaded {self.rows} rows into {self.table} ({self.rows / max(elapsed, 1e-6):.0f} rows/sec)", flush=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, *_):
+        if exception_type is None:
+            self.close()
+
+
+def memory_map(array, path):
+    """Write array to path and map it back read-only"""
+    np.save(path, array)
+    return np.load(path, mmap_mode="r")
+
+
+class SharedMetadata:
+    """Read-only metadata of documents 0 to size - 1, stored in memory-mapped files: one UTF-8 blob of all
+    values per field with their offsets. Forked workers read it without touching (and copying) Python objects"""
+
+    def __init__(self, metadata, size, field_names, path):
+        self.fields = {}
+        for field_number, field in enumerate(field_names):
+            offsets = np.zeros(size + 1, dtype=np.int64)
+            present = np.zeros(size, dtype=bool)
+            blob = bytearray()
+            for doc_id in range(size):
+                value = metadata.get(doc_id, {}).get(field)
+                if value is not None:
+                    blob += str(value).encode("utf-8")
+                    present[doc_id] = True
+                offsets[doc_id + 1] = len(blob)
+            self.fields[field] = (
+                memory_map(np.frombuffer(bytes(blob), dtype=np.uint8), os.path.join(path, f"field_{field_number}.npy")),
+                memory_map(offsets, os.path.join(path, f"field_{field_number}_offsets.npy")),
+                memory_map(present, os.path.join(path, f"field_{field_number}_present.npy")),
+            )
+
+    def __getitem__(self, doc_id):
+        doc_metadata = {}
+        for field, (blob, offsets, present) in self.fields.items():
+            if present[doc_id]:
+                doc_metadata[field] = blob[offsets[doc_id] : offsets[doc_id + 1]].tobytes().decode("utf-8")
+        return doc_metadata
+
+
+def top_k_similar(vectors, k, max_block_elements=16777216):
+    """Ids and cosine similarities of the k most similar other rows for each row of vectors (dense or sparse).
+    Similarities are computed over blocks of rows so that no more than max_block_elements are held at once"""
+    vectors = normalize(vectors)
+    size = vectors.shape[0]
+    k = min(k, size - 1)
+    block_size = max(1, max_block_elements // size)
+    ids = np.zeros((size, k), dtype=np.int64)
+    similarities = np.zeros((size, k), dtype=vectors.dtype)
+    # Transpose once: a sparse transpose is a CSC view that each block product would convert to CSR again
+    vectors_t = vectors.T.tocsr() if hasattr(vectors, "tocsr") else np.ascontiguousarray(vectors.T)
+    for start in tqdm(range(0, size, block_size), leave=False, desc="Computing similarities"):
+        stop = min(start + block_size, size)
+        block = vectors[start:stop] @ vectors_t
+        block = block.toarray() if hasattr(block, "toarray") else np.asarray(block)
+        block[np.arange(stop - start), np.arange(start, stop)] = -np.inf  # exclude the row itself
+        ids[start:stop] = top_k_columns(block, k, block_size=stop - start)
+        similarities[start:stop] = np.take_along_axis(block, ids[start:stop], axis=1)
+    return ids, similarities
+
+
+async def init_async_connection(connection):
+    """Decode JSONB columns to Python objects, as psycopg2 does"""
+    await connection.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+class AsyncConnectionPool:
+    """asyncpg connection pool with health checks and wait time metrics. asyncpg makes borrowers wait once max_size
+    connections are in use. Connections left idle for more than health_check_interval seconds are checked with
+    SELECT 1 when borrowed, and broken ones are closed so that asyncpg replaces them"""
+
+    def __init__(self, config, min_size=1, max_size=10, health_check_interval=30):
+        self.config = config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.pool = None
+        self.last_used = {}  # time each connection, by server process id, was last returned to the pool
+        self.borrowed = 0
+        self.replaced = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def open(self):
+        self.pool = await asyncpg.create_pool(
+            user=self.config["database_user"],
+            password=self.config["database_password"],
+            database=self.config["database_name"],
+            min_size=self.min_size,
+            max_size=self.max_size,
+            init=init_async_connection,
+        )
+        return self
+
+    async def is_healthy(self, connection):
+        last_used = self.last_used.get(connection.get_server_pid())
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            await connection.fetchval("SELECT 1", timeout=5)
+            return True
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError):
+            return False
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        start_time = time.perf_counter()
+        connection = await self.pool.acquire()
+        for _ in range(self.max_size):
+            if await self.is_healthy(connection):
+                break
+            self.last_used.pop(connection.get_server_pid(), None)
+            connection.terminate()
+            await self.pool.release(connection)
+            self.replaced += 1
+            connection = await self.pool.acquire()  # reconnects in place of the closed connection
+        wait_time = time.perf_counter() - start_time
+        self.borrowed += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            yield connection
+        finally:
+            self.last_used[connection.get_server_pid()] = time.monotonic()
+            await self.pool.release(connection)
+
+    def stats(self):
+        """Usage and wait time metrics of the pool"""
+        return {
+            "max_size": self.max_size,
+            "size": self.pool.get_size(),
+            "in_use": self.pool.get_size() - self.pool.get_idle_size(),
+            "borrowed": self.borrowed,
+            "replaced": self.replaced,
+            "total_wait_time": self.total_wait_time,
+            "max_wait_time": self.max_wait_time,
+            "average_wait_time": self.total_wait_time / max(self.borrowed, 1),
+        }
+
+
+ASYNC_CONNECTION_POOLS = {}
+
+
+async def async_connection_pool(config):
+    """asyncpg connection pool of the current process for the database in config, opened on first use"""
+    key = (os.getpid(), config["database_name"], config["database_user"])
+    if key not in ASYNC_CONNECTION_POOLS:
+        pool = AsyncConnectionPool(
+            config,
+            min_size=int(config.get("pool_min_size", 1)),
+            max_size=int(config.get("pool_max_size", 10)),
+            health_check_interval=float(config.get("pool_health_check_interval", 30)),
+        )
+        ASYNC_CONNECTION_POOLS[key] = asyncio.ensure_future(pool.open())  # shared by concurrent first requests
+    try:
+        return await ASYNC_CONNECTION_POOLS[key]
+    except Exception:
+        ASYNC_CONNECTION_POOLS.pop(key, None)
+        raise
 
 
 class DBHandler:
@@ -23,9 +263,14 @@ class DBHandler:
     cursor = None
     model = None
     metadata = None
-    table = None
+    table = None  # staging table prefix the model is built into
+    live_table = None  # table prefix the model is served from
     docs_per_year = None
     field_names = None
+    topic_evolution_labels = None
+    topic_evolutions = None
+    compact_arrays = False  # store weight vectors as packed float32 instead of JSON label/data objects
+    shared_path = None  # memory-mapped copies of the model read by worker pools
 
     def __init__(self):
         pass
@@ -40,6 +285,7 @@ class DBHandler:
         min_year,
         max_year,
         topics_over_time_interval,
+        compact_arrays=False,
     ):
         cls.db = psycopg2.connect(
             user=config["database_user"],
@@ -53,7 +299,9 @@ class DBHandler:
         for doc_metadata in cls.metadata.values():
             field_names.update(doc_metadata.keys())
         cls.field_names = list(field_names)
-        cls.table = table
+        cls.live_table = table
+        cls.table = f"{table}_staging"
+        cls.compact_arrays = compact_arrays
         label_map = {}
         if topics_over_time_interval != 1:
             for year in range(min_year, max_year + 1):
@@ -71,98 +319,195 @@ class DBHandler:
         return cls()
 
     @classmethod
-    def save_words(cls):
+    def share_model(cls):
+        """Move the matrices, feature names, metadata and ANN indexes read by worker pools to memory-mapped files
+        before forking, so that all workers read the same pages instead of gradually copying them. The files are
+        written to the system temp directory (TMPDIR), on disk, so the kernel can evict their pages under pressure"""
+        if cls.shared_path is not None:
+            return
+        cls.shared_path = tempfile.mkdtemp(prefix="topologic_")
+        atexit.register(shutil.rmtree, cls.shared_path, True)
+        corpus = cls.model.corpus
+        vectors = corpus.sklearn_vector_space.tocsr()
+        corpus.sklearn_vector_space = csr_matrix(
+            (
+                memory_map(vectors.data, os.path.join(cls.shared_path, "vectors_data.npy")),
+                memory_map(vectors.indices, os.path.join(cls.shared_path, "vectors_indices.npy")),
+                memory_map(vectors.indptr, os.path.join(cls.shared_path, "vectors_indptr.npy")),
+            ),
+            shape=vectors.shape,
+            copy=False,
+        )
+        corpus.feature_names = memory_map(
+            np.asarray(corpus.feature_names, dtype=str), os.path.join(cls.shared_path, "feature_names.npy")
+        )
+        for attribute in ("document_topic_matrix", "topic_word_matrix", "top_word_ids", "top_document_ids"):
+            setattr(
+                cls.model,
+                attribute,
+                memory_map(getattr(cls.model, attribute), os.path.join(cls.shared_path, f"{attribute}.npy")),
+            )
+        cls.metadata = SharedMetadata(cls.metadata, corpus.size, cls.field_names, cls.shared_path)
+        for name, owner in (("vectors", corpus), ("topics", cls.model)):
+            if owner.annoy_index is not None:
+                owner.annoy_index.save(os.path.join(cls.shared_path, f"{name}.ann"))  # reloads as a memory map
+
+    @classmethod
+    def array_type(cls):
+        return "BYTEA" if cls.compact_arrays is True else "JSONB"
+
+    @classmethod
+    def array_column(cls, labels, values):
+        """Value of a weight vector column in the storage layout of the tables"""
+        if cls.compact_arrays is True:
+            return pack_array(values)
+        return json.dumps({"labels": labels, "data": [float(value) for value in values]})
+
+    @classmethod
+    def save_labels(cls):
+        """Save labels of packed weight vectors once for all rows"""
+        cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_labels")
+        cls.cursor.execute(f"CREATE TABLE {cls.table}_labels(name TEXT, labels JSONB)")
+        cls.cursor.execute(
+            f"INSERT INTO {cls.table}_labels (name, labels) VALUES (%s, %s), (%s, %s)",
+            ("topics", json.dumps(list(range(cls.model.nb_topics))), "years", json.dumps(cls.topic_evolution_labels)),
+        )
+        cls.db.commit()
+
+    @classmethod
+    def publish(cls, switch_app=None):
+        """Replace the live tables of the model with the staging tables, and rename their indexes, in a single
+        transaction so that readers see either the previous model or the new one. switch_app is called once the
+        tables are renamed, just before the transaction commits, so that the web app switches to the new build
+        while readers of the live tables wait on the renames"""
+        # Postgres folds unquoted identifiers to lower case, so the catalogs hold lower-cased table names
+        staging_prefix = cls.table.lower()
+        live_prefix = cls.live_table.lower()
+        cls.cursor.execute("SELECT tablename FROM pg_tables WHERE schemaname = current_schema()")
+        staging_tables = [row[0] for row in cls.cursor.fetchall() if row[0].startswith(f"{staging_prefix}_")]
+        if not staging_tables:
+            cls.db.rollback()
+            raise Exception(f"No staging tables {staging_prefix}_* to publish")
+        try:
+            for staging_table in staging_tables:
+                live_table = f"{live_prefix}{staging_table[len(staging_prefix) :]}"
+                cls.cursor.execute(f"DROP TABLE IF EXISTS {live_table}")
+                cls.cursor.execute(
+                    "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+                    (staging_table,),
+                )
+                for (index_name,) in cls.cursor.fetchall():
+                    if index_name.startswith(staging_prefix):
+                        cls.cursor.execute(
+                            f"ALTER INDEX {index_name} RENAME TO {live_prefix}{index_name[len(staging_prefix) :]}"
+                        )
+                cls.cursor.execute(f"ALTER TABLE {staging_table} RENAME TO {live_table}")
+            if switch_app is not None:
+                switch_app()
+        except Exception:
+            cls.db.rollback()
+            raise
+        cls.db.commit()
+
+    @classmethod
+    def compute_word_postings(cls):
+        """Documents of each word sorted by decreasing TF-IDF score (ties by document id), returned as
+        CSC-style arrays: documents of word_id are doc_ids[indptr[word_id] : indptr[word_id + 1]]"""
+        postings = cls.model.corpus.sklearn_vector_space.tocsc()
+        postings.eliminate_zeros()
+        doc_counts = np.diff(postings.indptr)
+        idf = np.log(cls.model.corpus.size / np.maximum(doc_counts, 1))
+        scores = postings.data * np.repeat(idf, doc_counts)
+        order = np.lexsort((postings.indices, -scores, np.repeat(np.arange(len(doc_counts)), doc_counts)))
+        return postings.indptr, postings.indices[order], scores[order]
+
+    @classmethod
+    def save_words(cls, similar_words=100, docs_per_word=100):
         cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_words")
         cls.cursor.execute(
-            f"CREATE TABLE {cls.table}_words(word_id INTEGER, word TEXT, distribution_across_topics JSONB, docs JSONB, similar_words_by_topic JSONB, similar_words_by_cooc JSONB)"
+            f"CREATE TABLE {cls.table}_words(word_id INTEGER, word TEXT, distribution_across_topics {cls.array_type()}, docs JSONB, similar_words_by_topic JSONB, similar_words_by_cooc JSONB)"
         )
+        cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_word_docs")
+        cls.cursor.execute(f"CREATE TABLE {cls.table}_word_docs(word_id INTEGER, rank INTEGER, doc_id INTEGER, score FLOAT)")
 
         # Compute word similarity based on topic distributions
         print("Compute word similarity by distribution over topics...", flush=True)
-        word_similarities_by_topic = pairwise_distances(
-            cls.model.topic_word_matrix.transpose(), metric="cosine", n_jobs=-1
+        similar_words_by_topic_ids, similar_words_by_topic_weights = top_k_similar(
+            cls.model.topic_word_matrix.transpose(), similar_words
         )
 
         # Compute word similarity based on document co-occurrence
         print("Compute word similarity by document co-occurrence...", flush=True)
-        word_similarities_by_cooc = pairwise_distances(
-            cls.model.corpus.sklearn_vector_space.transpose(),
-            metric="cosine",
-            n_jobs=-1,
+        similar_words_by_cooc_ids, similar_words_by_cooc_weights = top_k_similar(
+            cls.model.corpus.sklearn_vector_space.transpose().tocsr(), similar_words
         )
-        # Get word weights across docs
-        word_weights = {}
-        for doc_id, doc_vector in tqdm(
-            enumerate(cls.model.corpus.sklearn_vector_space),
-            leave=False,
-            total=cls.model.corpus.size,
-            desc="Getting all token weights across docs",
-        ):
-            doc_vector = doc_vector.toarray()[0]
-            for word_id in np.argsort(doc_vector)[::-1]:
-                weight = doc_vector[word_id]
-                if weight <= 0.0:
-                    break
-                if word_id not in word_weights:
-                    word_weights[word_id] = []
-                word_weights[word_id].append((doc_id, weight))
-
-        for word_id, docs in tqdm(
-            word_weights.items(),
+        # Get TF-IDF scores of documents for each word
+        indptr, posting_doc_ids, posting_scores = cls.compute_word_postings()
+        doc_counts = np.diff(indptr)
+        posting_word_ids = np.repeat(np.arange(len(doc_counts)), doc_counts)
+        posting_ranks = np.arange(len(posting_doc_ids)) - np.repeat(indptr[:-1], doc_counts)
+        with CopyLoader(cls.cursor, f"{cls.table}_word_docs", ("word_id", "rank", "doc_id", "score")) as loader:
+            for start in trange(0, len(posting_doc_ids), 100000, leave=False, desc="Saving word postings"):
+                block = slice(start, start + 100000)
+                loader.add_lines(
+                    copy_lines(
+                        "%d\t%d\t%d\t%r\n",
+                        posting_word_ids[block],
+                        posting_ranks[block],
+                        posting_doc_ids[block],
+                        posting_scores[block],
+                    ),
+                    len(posting_doc_ids[block]),
+                )
+        cls.cursor.execute(f"CREATE INDEX {cls.table}_word_docs_index ON {cls.table}_word_docs (word_id, rank)")
+
+        loader = CopyLoader(
+            cls.cursor,
+            f"{cls.table}_words",
+            ("word_id", "word", "distribution_across_topics", "docs", "similar_words_by_topic", "similar_words_by_cooc"),
+        )
+        for word_id in tqdm(
+            np.flatnonzero(doc_counts),
             leave=False,
             desc="Generating TF-IDF scores for all tokens",
         ):
             word = cls.model.corpus.feature_names[word_id]
-            idf = log(cls.model.corpus.size / len(docs))
-            sorted_docs = sorted(
-                [(doc_id, float(weight * idf)) for doc_id, weight in docs],
-                key=lambda x: x[1],
-                reverse=True,
-            )
+            top_docs = slice(indptr[word_id], min(indptr[word_id + 1], indptr[word_id] + docs_per_word))
+            sorted_docs = [
+                (int(doc_id), float(score)) for doc_id, score in zip(posting_doc_ids[top_docs], posting_scores[top_docs])
+            ]
             word_distribution = cls.model.topic_distribution_for_word(word_id)
-            topics = []
-            weights = []
-            for i in range(len(word_distribution)):
-                topics.append(i)
-                weights.append(word_distribution[i])
-
-            similar_words_topic_array = 1.0 - word_similarities_by_topic[word_id]  # convert distance to similarity
-            similar_words_by_topic = []
-            for other_word in np.argsort(similar_words_topic_array)[::-1]:
-                similar_words_by_topic.append(
-                    {
-                        "word": cls.model.corpus.feature_names[other_word],
-                        "weight": similar_words_topic_array[other_word],
-                    }
-                )
 
-            similar_words_cooc_array = 1.0 - word_similarities_by_cooc[word_id]  # convert distance to similarity
-            similar_words_by_cooc = []
-            for other_word in np.argsort(similar_words_cooc_array)[::-1]:
-                similar_words_by_cooc.append(
-                    {
-                        "word": cls.model.corpus.feature_names[other_word],
-                        "weight": similar_words_cooc_array[other_word],
-                    }
+            similar_words_by_topic = [
+                {"word": cls.model.corpus.feature_names[other_word], "weight": float(weight)}
+                for other_word, weight in zip(
+                    similar_words_by_topic_ids[word_id], similar_words_by_topic_weights[word_id]
                 )
+            ]
+            similar_words_by_cooc = [
+                {"word": cls.model.corpus.feature_names[other_word], "weight": float(weight)}
+                for other_word, weight in zip(similar_words_by_cooc_ids[word_id], similar_words_by_cooc_weights[word_id])
+            ]
 
-            cls.cursor.execute(
-                f"INSERT INTO {cls.table}_words (word_id, word, distribution_across_topics, docs, similar_words_by_topic, similar_words_by_cooc) VALUES (%s, %s, %s, %s, %s, %s)",
+            loader.add(
                 (
                     int(word_id),
                     word,
-                    json.dumps({"labels": topics, "data": weights}),
+                    cls.array_column(list(range(len(word_distribution))), word_distribution),
                     json.dumps(sorted_docs),
                     json.dumps(similar_words_by_topic),
                     json.dumps(similar_words_by_cooc),
-                ),
+                )
             )
+        loader.close()
         cls.cursor.execute(f"CREATE INDEX {cls.table}_word_id_index ON {cls.table}_words USING HASH(word_id)")
         cls.cursor.execute(f"CREATE INDEX {cls.table}_word_index ON {cls.table}_words USING HASH(word)")
         cls.db.commit()
 
     @classmethod
-    def save_docs(cls):
+    def save_docs(cls, block_size=1000, max_block_words=1000000):
+        """Save document rows, computed in blocks of at most block_size documents and, since each row holds the
+        full word list of its document, of at most max_block_words words unless a single document has more"""
         metadata_fields = []
         for field in cls.field_names:
             if field == "year":
@@ -171,79 +516,200 @@ class DBHandler:
                 metadata_fields.append(f"{field} TEXT")
         cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_docs")
         cls.cursor.execute(
-            f"CREATE TABLE {cls.table}_docs(doc_id INTEGER, topic_distribution JSONB, topic_similarity JSONB, vector_similarity JSONB, word_list JSONB, {', '.join(metadata_fields)})"
+            f"CREATE TABLE {cls.table}_docs(doc_id INTEGER, topic_distribution {cls.array_type()}, topic_similarity JSONB, vector_similarity JSONB, word_list JSONB, {', '.join(metadata_fields)})"
+        )
+        cls.share_model()
+        loader = CopyLoader(
+            cls.cursor,
+            f"{cls.table}_docs",
+            ["doc_id", "topic_distribution", "topic_similarity", "vector_similarity", "word_list"] + cls.field_names,
         )
+        indptr = cls.model.corpus.sklearn_vector_space.indptr
+        blocks = []
+        start = 0
+        while start < cls.model.corpus.size:
+            stop = min(start + block_size, int(np.searchsorted(indptr, indptr[start] + max_block_words, side="right")) - 1)
+            blocks.append((start, max(stop, start + 1)))
+            start = max(stop, start + 1)
         with tqdm(total=cls.model.corpus.size, leave=False, desc="Generating doc stats") as pbar:
             with Pool(cpu_count() - 1) as pool:
-                for values in pool.imap_unordered(cls.compute_doc, range(cls.model.corpus.size)):
-                    cls.cursor.execute(
-                        f"INSERT INTO {cls.table}_docs (doc_id, topic_distribution, topic_similarity, vector_similarity, word_list, {', '.join(cls.field_names)}) VALUES (%s, %s, %s, %s, %s, {', '.join(['%s' for _ in range(len(cls.field_names))])})",
-                        values,
-                    )
-
-                    pbar.update()
+                for lines, row_count in pool.imap_unordered(cls.compute_docs, blocks):
+                    loader.add_lines(lines, row_count)
+                    pbar.update(row_count)
+        loader.close()
         cls.cursor.execute(f"CREATE INDEX {cls.table}_doc_id_index ON {cls.table}_docs USING HASH(doc_id)")
         for field in cls.field_names:
             cls.cursor.execute(f"CREATE INDEX {cls.table}_{field}_index ON {cls.table}_docs USING HASH({field})")
         cls.db.commit()
 
     @classmethod
-    def compute_doc(cls, doc_id):
-        topics = []
-        weights = []
-        distribution = cls.model.topic_distribution_for_document(doc_id)
-        for i in range(len(distribution)):
-            topics.append(i)
-            weights.append(distribution[i])
-        topic_distribution = json.dumps({"labels": topics, "data": weights})
-
-        # Get similar docs
-        topic_similarity = json.dumps(
-            [
-                (int(another_doc), round(float(score), 3))
-                for another_doc, score in cls.model.corpus.similar_docs_by_topic_distribution(doc_id, 20, cls.model)
-            ]
-        )
-        vector_similarity = json.dumps(
-            [
-                (int(another_doc), round(float(score), 3))
-                for another_doc, score in cls.model.corpus.similar_docs_by_vector(doc_id, 20)
-            ]
-        )
+    def compute_docs(cls, bounds):
+        """Rows of documents start to stop - 1, formatted as COPY lines. Word lists are sorted over the CSR
+        slice of the whole block instead of densifying each document over the vocabulary"""
+        start, stop = bounds
+        corpus = cls.model.corpus
+        vectors = corpus.sklearn_vector_space[start:stop]
+        non_zero = vectors.data != 0
+        rows = np.repeat(np.arange(stop - start), np.diff(vectors.indptr))[non_zero]
+        word_ids = vectors.indices[non_zero]
+        weights = vectors.data[non_zero]
+        order = np.lexsort((word_ids, -weights, rows))  # decreasing weights, ties by word id
+        word_ids = word_ids[order].tolist()
+        weights = weights[order].tolist()
+        word_offsets = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=stop - start)))).tolist()
+
+        lines = []
+        for position, doc_id in enumerate(range(start, stop)):
+            distribution = cls.model.topic_distribution_for_document(doc_id)
+            topic_distribution = cls.array_column(list(range(len(distribution))), distribution)
+
+            # Get similar docs
+            topic_similarity = json.dumps(
+                [
+                    (int(another_doc), round(float(score), 3))
+                    for another_doc, score in corpus.similar_docs_by_topic_distribution(doc_id, 20, cls.model)
+                ]
+            )
+            vector_similarity = json.dumps(
+                [(int(another_doc), round(float(score), 3)) for another_doc, score in corpus.similar_docs_by_vector(doc_id, 20)]
+            )
 
-        # Get word_list
-        vector = cls.model.corpus.sklearn_vector_space[doc_id].toarray()[0]
-        non_zero = vector != 0
-        word_list = json.dumps(
-            [
-                (
-                    cls.model.corpus.feature_names[word_id],
-                    float(vector[word_id]),
-                    int(word_id),
+            # Get word_list
+            doc_words = slice(word_offsets[position], word_offsets[position + 1])
+            word_list = json.dumps(
+                [
+                    (str(corpus.feature_names[word_id]), weight, word_id)
+                    for word_id, weight in zip(word_ids[doc_words], weights[doc_words])
+                ]
+            )
+
+            # Get metadata values
+            field_values = []
+            for field in cls.field_names:
+                try:
+                    field_values.append(cls.metadata[doc_id][field])
+                except KeyError:
+                    field_values.append("")
+                if field == "year" and not field_values[-1]:  # in case the doc has no year
+                    field_values.pop()
+                    field_values.append(0)
+            lines.append(copy_line([doc_id, topic_distribution, topic_similarity, vector_similarity, word_list] + field_values))
+        return "".join(lines), stop - start
+
+    @classmethod
+    def save_metadata_distributions(cls, fields):
+        """Save the topic distribution of all documents sharing each value of the given metadata fields, summed
+        with one sparse product of a value x document indicator matrix and the document-topic matrix"""
+        cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_metadata_distributions")
+        cls.cursor.execute(
+            f"CREATE TABLE {cls.table}_metadata_distributions(field TEXT, value TEXT, doc_count INTEGER, topic_distribution {cls.array_type()})"
+        )
+        topic_ids = list(range(cls.model.nb_topics))
+        with CopyLoader(
+            cls.cursor, f"{cls.table}_metadata_distributions", ("field", "value", "doc_count", "topic_distribution")
+        ) as loader:
+            for field in fields:
+                if field not in cls.field_names:
+                    continue
+                doc_values = []
+                for doc_id in range(cls.model.corpus.size):
+                    try:
+                        doc_values.append(str(cls.metadata[doc_id][field]))
+                    except KeyError:
+                        doc_values.append("")
+                values, value_ids = np.unique(np.array(doc_values, dtype=object), return_inverse=True)
+                value_indicators = csr_matrix(
+                    (np.ones(len(value_ids)), (value_ids, np.arange(len(value_ids)))),
+                    shape=(len(values), cls.model.corpus.size),
                 )
-                for word_id in np.where(non_zero, vector, np.nan).argsort()[: non_zero.sum()][::-1]
-            ]
+                distributions = np.asarray(value_indicators @ cls.model.document_topic_matrix, dtype=np.float64)
+                totals = distributions.sum(axis=1, keepdims=True)
+                distributions = np.divide(distributions, totals, out=np.zeros_like(distributions), where=totals > 0)
+                doc_counts = np.bincount(value_ids, minlength=len(values))
+                for value, doc_count, distribution in zip(values, doc_counts.tolist(), distributions):
+                    loader.add((field, value, doc_count, cls.array_column(topic_ids, distribution)))
+        cls.cursor.execute(
+            f"CREATE INDEX {cls.table}_metadata_distributions_index ON {cls.table}_metadata_distributions (field, value)"
         )
+        cls.db.commit()
 
-        # Get metadata values
-        field_values = []
-        for field in cls.field_names:
+    @classmethod
+    def compute_topic_evolutions(cls, start_date, end_date, year_interval):
+        """Topic x year matrix of topic weights summed over each year's documents and divided by the
+        number of documents in that year, computed for all topics with one sparse product"""
+        cls.topic_evolution_labels = list(range(start_date, end_date, year_interval))
+        year_positions = {year: position for position, year in enumerate(cls.topic_evolution_labels)}
+        doc_ids = []
+        positions = []
+        weights = []
+        for doc_id in range(cls.model.corpus.size):
             try:
-                field_values.append(cls.metadata[doc_id][field])
-            except KeyError:
-                field_values.append("")
-            if field == "year" and not field_values[-1]:  # in case the doc has no year
-                field_values.pop()
-                field_values.append(0)
-        values = tuple([doc_id, topic_distribution, topic_similarity, vector_similarity, word_list] + field_values)
-        return values
+                year = cls.year_label_map[int(cls.metadata[doc_id]["year"])]
+                positions.append(year_positions[year])
+                doc_ids.append(doc_id)
+                weights.append(1.0 / cls.docs_per_year[year])
+            except (KeyError, ValueError):  # account for various issues with year field
+                pass
+        year_indicators = csr_matrix(
+            (weights, (doc_ids, positions)), shape=(cls.model.corpus.size, len(cls.topic_evolution_labels))
+        )
+        cls.topic_evolutions = np.asarray((year_indicators.T @ cls.model.document_topic_matrix).T)
+        cls.year_doc_ids = np.array(doc_ids, dtype=np.int64)
+        cls.year_positions = np.array(positions, dtype=np.int64)
+
+    @classmethod
+    def save_topic_year_docs(cls, limit=50):
+        """Save the limit top documents of each topic in each year of the topic evolutions, so that browsing
+        a topic by year is a single indexed read"""
+        cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_topic_year_docs")
+        cls.cursor.execute(
+            f"CREATE TABLE {cls.table}_topic_year_docs(topic_id INTEGER, year INTEGER, rank INTEGER, doc_id INTEGER, score FLOAT)"
+        )
+        indptr = cls.model.corpus.sklearn_vector_space.indptr
+        non_empty = indptr[cls.year_doc_ids + 1] > indptr[cls.year_doc_ids]  # skip empty document vectors
+        doc_ids = cls.year_doc_ids[non_empty]
+        positions = cls.year_positions[non_empty]
+        order = np.argsort(positions, kind="stable")
+        doc_ids = doc_ids[order]
+        bounds = np.searchsorted(positions[order], np.arange(len(cls.topic_evolution_labels) + 1))
+        with CopyLoader(
+            cls.cursor, f"{cls.table}_topic_year_docs", ("topic_id", "year", "rank", "doc_id", "score")
+        ) as loader:
+            for position, year in enumerate(
+                tqdm(cls.topic_evolution_labels, leave=False, desc="Saving top documents by year")
+            ):
+                docs_in_year = doc_ids[bounds[position] : bounds[position + 1]]
+                if len(docs_in_year) == 0:
+                    continue
+                year_weights = np.asarray(cls.model.document_topic_matrix[docs_in_year]).T
+                top_docs = top_k_columns(year_weights, limit)
+                top_weights = np.take_along_axis(year_weights, top_docs, axis=1)
+                for topic_id in range(cls.model.nb_topics):
+                    for rank, (doc_index, weight) in enumerate(
+                        zip(top_docs[topic_id].tolist(), top_weights[topic_id].tolist())
+                    ):
+                        if weight <= 0:
+                            break
+                        loader.add((topic_id, year, rank, int(docs_in_year[doc_index]), weight))
+        cls.cursor.execute(
+            f"CREATE INDEX {cls.table}_topic_year_docs_index ON {cls.table}_topic_year_docs (topic_id, year, rank)"
+        )
 
     @classmethod
     def save_topics(cls, topic_words_path, start_date, end_date, year_interval):
         topic_words = []
+        cls.compute_topic_evolutions(start_date, end_date, year_interval)
+        if cls.compact_arrays is True:
+            cls.save_labels()
         cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_topics")
         cls.cursor.execute(
-            f"CREATE TABLE {cls.table}_topics(topic_id INTEGER, word_distribution JSONB, topic_evolution JSONB, frequency FLOAT, docs JSONB)"
+            f"CREATE TABLE {cls.table}_topics(topic_id INTEGER, word_distribution JSONB, topic_evolution {cls.array_type()}, frequency FLOAT, docs JSONB)"
+        )
+        cls.share_model()
+        loader = CopyLoader(
+            cls.cursor,
+            f"{cls.table}_topics",
+            ("topic_id", "word_distribution", "topic_evolution", "frequency", "docs"),
         )
         with tqdm(total=cls.model.nb_topics, leave=False, desc="Generating topic stats") as pbar:
             with Pool(cpu_count() - 1) as pool:
@@ -254,19 +720,8 @@ class DBHandler:
                     frequency,
                     docs,
                     description,
-                ) in pool.imap_unordered(
-                    cls.compute_topic,
-                    zip(
-                        range(cls.model.nb_topics),
-                        repeat(start_date),
-                        repeat(end_date),
-                        repeat(year_interval),
-                    ),
-                ):
-                    cls.cursor.execute(
-                        f"INSERT INTO {cls.table}_topics (topic_id, word_distribution, topic_evolution, frequency, docs) VALUES (%s, %s, %s, %s, %s)",
-                        (topic_id, word_distribution, topic_evolution, frequency, docs),
-                    )
+                ) in pool.imap_unordered(cls.compute_topic, range(cls.model.nb_topics)):
+                    loader.add((topic_id, word_distribution, topic_evolution, frequency, docs))
                     topic_words.append(
                         {
                             "name": topic_id,
@@ -275,43 +730,77 @@ class DBHandler:
                         }
                     )
                     pbar.update()
+        loader.close()
 
         topic_words.sort(key=lambda x: x["name"])
         with open(topic_words_path, "w") as out_file:
             json.dump(topic_words, out_file)
 
         cls.cursor.execute(f"CREATE INDEX {cls.table}_topic_id_index on {cls.table}_topics USING HASH(topic_id)")
+        cls.save_topic_similarity()
+        cls.save_topic_year_docs()
         cls.db.commit()
 
     @classmethod
-    def compute_topic(cls, topic):
-        topic_id, start_date, end_date, year_interval = topic
+    def topic_similarity(cls, vectors):
+        """Cosine similarities between all topic vectors, and the rank of each other topic by decreasing
+        similarity for each topic (ties by topic id)"""
+        similarities = np.zeros((cls.model.nb_topics, cls.model.nb_topics))
+        ranks = np.zeros((cls.model.nb_topics, cls.model.nb_topics), dtype=np.int64)
+        if cls.model.nb_topics > 1:
+            ids, top_similarities = top_k_similar(vectors, cls.model.nb_topics - 1)
+            np.put_along_axis(similarities, ids, top_similarities, axis=1)
+            np.put_along_axis(ranks, ids, np.broadcast_to(np.arange(ids.shape[1]), ids.shape), axis=1)
+        return similarities, ranks
+
+    @classmethod
+    def save_topic_similarity(cls):
+        """Save the similarity of all pairs of topics, by evolution over time and by distribution over words"""
+        cls.cursor.execute(f"DROP TABLE IF EXISTS {cls.table}_topic_similarity")
+        cls.cursor.execute(
+            f"CREATE TABLE {cls.table}_topic_similarity(topic_id INTEGER, other_topic_id INTEGER, evolution_similarity FLOAT, evolution_rank INTEGER, word_similarity FLOAT, word_rank INTEGER)"
+        )
+        evolution_similarities, evolution_ranks = cls.topic_similarity(cls.topic_evolutions)
+        word_similarities, word_ranks = cls.topic_similarity(cls.model.topic_word_matrix)
+        with CopyLoader(
+            cls.cursor,
+            f"{cls.table}_topic_similarity",
+            ("topic_id", "other_topic_id", "evolution_similarity", "evolution_rank", "word_similarity", "word_rank"),
+        ) as loader:
+            for topic_id in range(cls.model.nb_topics):
+                for other_topic_id in range(cls.model.nb_topics):
+                    if other_topic_id != topic_id:
+                        loader.add(
+                            (
+                                topic_id,
+                                other_topic_id,
+                                float(evolution_similarities[topic_id, other_topic_id]),
+                                int(evolution_ranks[topic_id, other_topic_id]),
+                                float(word_similarities[topic_id, other_topic_id]),
+                                int(word_ranks[topic_id, other_topic_id]),
+                            )
+                        )
+        cls.cursor.execute(
+            f"CREATE INDEX {cls.table}_topic_similarity_index ON {cls.table}_topic_similarity (topic_id, evolution_rank)"
+        )
+
+    @classmethod
+    def compute_topic(cls, topic_id):
         # Get word distributions
         words, weights = zip(*cls.model.top_words(topic_id, 50))
-        word_distribution = json.dumps({"labels": words, "data": weights})
+        word_distribution = json.dumps({"labels": words, "data": [float(weight) for weight in weights]})
 
         # Compute topic evolution
-        years = {year: 0.0 for year in range(start_date, end_date, year_interval)}
-        for doc_id in range(cls.model.corpus.size):
-            try:
-                year = cls.year_label_map[int(cls.metadata[doc_id]["year"])]
-                years[year] += (
-                    float(cls.model.topic_distribution_for_document(doc_id)[topic_id]) / cls.docs_per_year[year]
-                )
-            except (KeyError, ValueError):  # account for various issues with year field
-                pass
-
-        dates, frequencies = zip(*list(years.items()))
-        topic_evolution = json.dumps({"labels": dates, "data": frequencies})
+        topic_evolution = cls.array_column(cls.topic_evolution_labels, cls.topic_evolutions[topic_id])
 
         # Get top documents per topic
-        ids = cls.model.top_documents(topic_id)
+        ids = cls.model.top_documents(topic_id, cls.model.top_k_documents)
         documents = []
+        indptr = cls.model.corpus.sklearn_vector_space.indptr
         for document_id, weight in ids:
-            document_array = cls.model.corpus.sklearn_vector_space[document_id]
-            if np.max(document_array.todense()) > 0:
+            if weight > 0 and indptr[document_id + 1] > indptr[document_id]:  # skip zero weights and empty document vectors
                 documents.append((int(document_id), float(weight)))
-        frequency = cls.model.get_topic_frequency(topic_id)
+        frequency = float(cls.model.get_topic_frequency(topic_id))
         docs = json.dumps(documents)
         description = []
         for weighted_word in cls.model.top_words(topic_id, 10):
@@ -326,78 +815,94 @@ class DBHandler:
         )
 
 
-class DBSearch:
-    def __init__(self, config, table, object_level):
-        self.db = psycopg2.connect(
-            user=config["database_user"],
-            password=config["database_password"],
-            database=config["database_name"],
-        )
-        self.cursor = self.db.cursor(cursor_factory=RealDictCursor)
+class AsyncDBSearch:
+    """Queries of a model's tables for the async API server. Each query borrows its own connection from the
+    pool, so that independent queries run concurrently with asyncio.gather"""
+
+    def __init__(self, pool, table, object_level, compact_arrays=False):
+        self.pool = pool
         self.table = table
         self.object_level = object_level
-
-    def get_vocabulary(self):
-        self.cursor.execute(f"SELECT word FROM {self.table}_words")
-        return sorted([result["word"] for result in self.cursor])
-
-    def get_all_metadata_values(self, field, frequency_filter=1):
+        self.compact_arrays = compact_arrays
+        self.__labels = None
+
+    async def fetch(self, query, *args):
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(query, *args)
+
+    async def fetchrow(self, query, *args):
+        async with self.pool.acquire() as connection:
+            row = await connection.fetchrow(query, *args)
+        return dict(row) if row is not None else None
+
+    async def labels(self, name):
+        """Labels of packed weight vectors: topics or years"""
+        if self.__labels is None:
+            rows = await self.fetch(f"SELECT name, labels FROM {self.table}_labels")
+            self.__labels = {row["name"]: row["labels"] for row in rows}
+        return self.__labels[name]
+
+    def array_data(self, value):
+        """Weights of a weight vector column as a NumPy array"""
+        if self.compact_arrays is True:
+            return np.frombuffer(value, dtype="<f4")
+        return np.array(value["data"])
+
+    async def labeled_array(self, value, labels_name):
+        """Weight vector column as a labels/data object"""
+        if self.compact_arrays is True:
+            return {"labels": await self.labels(labels_name), "data": self.array_data(value).tolist()}
+        return value
+
+    async def get_vocabulary(self):
+        rows = await self.fetch(f"SELECT word FROM {self.table}_words")
+        return sorted([row["word"] for row in rows])
+
+    async def get_all_metadata_values(self, field, frequency_filter=1):
         if frequency_filter == 1:
-            self.cursor.execute(f"SELECT DISTINCT {field} FROM {self.table}_docs")
-            return sorted([row[field] for row in self.cursor if row[field]])
-        self.cursor.execute(f"SELECT {field}, COUNT(*) AS field_count FROM {self.table}_docs GROUP BY {field}")
-        return sorted([row[field] for row in self.cursor if row[field] and row["field_count"] >= frequency_filter])
+            rows = await self.fetch(f"SELECT DISTINCT {field} FROM {self.table}_docs")
+            return sorted([row[field] for row in rows if row[field]])
+        rows = await self.fetch(f"SELECT {field}, COUNT(*) AS field_count FROM {self.table}_docs GROUP BY {field}")
+        return sorted([row[field] for row in rows if row[field] and row["field_count"] >= frequency_filter])
 
-    def get_doc_data(self, philo_id, philo_db):
+    async def get_doc_data(self, philo_id, philo_db):
         philo_id = " ".join(philo_id.split()[: OBJECT_LEVELS[self.object_level]])
-        self.cursor.execute(
-            f"SELECT * FROM {self.table}_docs WHERE philo_{self.object_level}_id=%s AND philo_db=%s",
-            (philo_id, philo_db),
-        )
-        return self.cursor.fetchone()
-
-    def get_metadata(self, doc_id, metadata_fields):
-        self.cursor.execute(
-            f"SELECT {', '.join(metadata_fields)} FROM {self.table}_docs WHERE doc_id=%s",
-            (doc_id,),
+        doc_data = await self.fetchrow(
+            f"SELECT * FROM {self.table}_docs WHERE philo_{self.object_level}_id=$1 AND philo_db=$2",
+            philo_id,
+            philo_db,
         )
-        return self.cursor.fetchone()
-
-    def get_doc_ids_by_metadata(self, field, value, end_value=None):
-        if end_value is None:
-            self.cursor.execute(
-                f"SELECT distinct doc_id FROM {self.table}_docs WHERE {field}=%s",
-                (value,),
-            )
-        else:
-            self.cursor.execute(
-                f"SELECT distinct doc_id, year FROM {self.table}_docs WHERE {field}>=%s and {field}<%s",
-                (value, end_value),
-            )
-        return set(row["doc_id"] for row in self.cursor)
-
-    def get_topic_data(self, topic_id, metadata_fields):
-        self.cursor.execute(f"SELECT * FROM {self.table}_topics WHERE topic_id=%s", (topic_id,))
-        topic_data = self.cursor.fetchone()
-        documents = []
-        for document_id, weight in topic_data["docs"][:50]:
-            metadata = self.get_metadata(document_id, metadata_fields)
-            documents.append({"doc_id": document_id, "metadata": metadata, "score": weight})
-        current_topic_evolution = topic_data["topic_evolution"]
-        current_topic_evolution_array = np.array([current_topic_evolution["data"]])
-        similar_topics = []
-        for topic, topic_evolution in self.get_topic_evolutions(int(topic_id)):
-            similarity = float(
-                cosine_similarity(current_topic_evolution_array, np.array([topic_evolution["data"]]))[0, 0]
+        if doc_data is not None:
+            doc_data["topic_distribution"] = await self.labeled_array(doc_data["topic_distribution"], "topics")
+        return doc_data
+
+    async def get_metadata_for_docs(self, doc_ids, metadata_fields):
+        """Get the metadata of several documents with a single query, keyed by doc_id (None for missing docs)"""
+        metadata = {doc_id: None for doc_id in doc_ids}
+        if metadata:
+            rows = await self.fetch(
+                f"SELECT doc_id, {', '.join(metadata_fields)} FROM {self.table}_docs WHERE doc_id = ANY($1::integer[])",
+                list(metadata),
             )
-            similar_topics.append(
-                {
-                    "topic": topic,
-                    "topic_evolution": topic_evolution,
-                    "score": similarity,
-                }
-            )
-        similar_topics.sort(key=lambda x: x["score"], reverse=True)
+            for row in rows:
+                row = dict(row)
+                metadata[row.pop("doc_id")] = row
+        return metadata
+
+    async def get_topic_data(self, topic_id, metadata_fields, similar_topics_limit=10):
+        topic_data, (similar_topics, similar_topics_by_words) = await asyncio.gather(
+            self.fetchrow(f"SELECT * FROM {self.table}_topics WHERE topic_id=$1", topic_id),
+            self.get_similar_topics(topic_id, similar_topics_limit),
+        )
+        top_docs = topic_data["docs"][:50]
+        metadata, current_topic_evolution = await asyncio.gather(
+            self.get_metadata_for_docs([document_id for document_id, _ in top_docs], metadata_fields),
+            self.labeled_array(topic_data["topic_evolution"], "years"),
+        )
+        documents = [
+            {"doc_id": document_id, "metadata": metadata[document_id], "score": weight}
+            for document_id, weight in top_docs
+        ]
         word_distribution = {"data": [], "labels": []}
         for weight, word in zip(topic_data["word_distribution"]["data"], topic_data["word_distribution"]["labels"]):
             if len(word_distribution["data"]) < 50:
@@ -409,61 +914,83 @@ class DBSearch:
             "documents": documents,
             "frequency": topic_data["frequency"],
             "similar_topics": similar_topics,
+            "similar_topics_by_words": similar_topics_by_words,
         }
 
-    def get_topic_data_by_year(self, topic_id, year, interval, metadata_fields, limit):
-        self.cursor.execute(f"SELECT * FROM {self.table}_topics WHERE topic_id=%s", (topic_id,))
-        topic_data = self.cursor.fetchone()
-        if interval == 1:
-            doc_ids = self.get_doc_ids_by_metadata("year", year)
-        else:
-            doc_ids = self.get_doc_ids_by_metadata("year", year, end_value=int(year) + interval)
-        documents = []
-        doc_counts = 0
-        for doc_id, weight in topic_data["docs"]:
-            if doc_id in doc_ids:
-                metadata = self.get_metadata(doc_id, metadata_fields)
-                documents.append({"doc_id": doc_id, "metadata": metadata, "score": weight})
-                doc_counts += 1
-            if doc_counts == 50:
-                break
-        return documents
+    async def get_topic_data_by_year(self, topic_id, year, metadata_fields, limit=50):
+        """The top documents of a topic in a year of its evolution, read from the precomputed table"""
+        rows = await self.fetch(
+            f"SELECT doc_id, score FROM {self.table}_topic_year_docs WHERE topic_id=$1 AND year=$2 ORDER BY rank LIMIT $3",
+            topic_id,
+            int(year),
+            limit,
+        )
+        metadata = await self.get_metadata_for_docs([row["doc_id"] for row in rows], metadata_fields)
+        return [{"doc_id": row["doc_id"], "metadata": metadata[row["doc_id"]], "score": row["score"]} for row in rows]
+
+    async def get_similar_topics(self, topic_id, limit=10):
+        """The limit other topics most similar by evolution over time, with their evolution, and the limit other
+        topics most similar by word distribution, read from the precomputed topic similarity table"""
+        rows = await self.fetch(
+            f"SELECT similarity.other_topic_id, similarity.evolution_similarity, similarity.evolution_rank, similarity.word_similarity, similarity.word_rank, CASE WHEN similarity.evolution_rank<$2 THEN topics.topic_evolution END AS topic_evolution FROM {self.table}_topic_similarity AS similarity JOIN {self.table}_topics AS topics ON topics.topic_id=similarity.other_topic_id WHERE similarity.topic_id=$1 AND (similarity.evolution_rank<$2 OR similarity.word_rank<$2)",
+            topic_id,
+            limit,
+        )
+        similar_topics = [
+            {
+                "topic": row["other_topic_id"],
+                "topic_evolution": await self.labeled_array(row["topic_evolution"], "years"),
+                "score": row["evolution_similarity"],
+            }
+            for row in sorted(rows, key=lambda row: row["evolution_rank"])[:limit]
+        ]
+        similar_topics_by_words = [
+            {"topic": row["other_topic_id"], "score": row["word_similarity"]}
+            for row in sorted(rows, key=lambda row: row["word_rank"])[:limit]
+        ]
+        return similar_topics, similar_topics_by_words
 
-    def get_topic_evolutions(self, topic_id):
-        self.cursor.execute(
-            f"SELECT topic_id, topic_evolution FROM {self.table}_topics WHERE topic_id!=%s",
-            (topic_id,),
+    async def get_word_data(self, word):
+        word_data = await self.fetchrow(f"SELECT * FROM {self.table}_words WHERE word=$1", word)
+        if word_data is not None:
+            word_data["distribution_across_topics"] = await self.labeled_array(
+                word_data["distribution_across_topics"], "topics"
+            )
+        return word_data
+
+    async def get_word_docs(self, word, start=0, limit=50):
+        """Get a page of the documents of a word, ranked by decreasing TF-IDF score"""
+        rows = await self.fetch(
+            f"SELECT word_docs.doc_id, word_docs.score FROM {self.table}_word_docs AS word_docs JOIN {self.table}_words AS words ON words.word_id=word_docs.word_id WHERE words.word=$1 AND word_docs.rank>=$2 ORDER BY word_docs.rank LIMIT $3",
+            word,
+            start,
+            limit,
         )
-        return [(row["topic_id"], row["topic_evolution"]) for row in self.cursor]
-
-    def get_word_data(self, word):
-        self.cursor.execute(f"SELECT * FROM {self.table}_words WHERE word=%s", (word,))
-        return self.cursor.fetchone()
-
-    def get_word_from_id(self, word_id):
-        self.cursor.execute(f"SELECT word FROM {self.table}_words WHERE word_id=%s", (word_id,))
-        return self.cursor.fetchone()[0]
-
-    def get_topic_distribution_by_metadata(self, field, field_value):
-        topic_distribution = []
-        self.cursor.execute(f"SELECT * FROM {self.table}_docs WHERE {field}=%s", (field_value,))
-        for row in self.cursor:
-            if not topic_distribution:
-                topic_distribution = [
-                    {"name": pos, "frequency": weight} for pos, weight in enumerate(row["topic_distribution"]["data"])
-                ]
-            else:
-                for pos, weight in enumerate(row["topic_distribution"]["data"]):
-                    topic_distribution[pos]["frequency"] += weight
-        coeff = 1.0 / sum([topic["frequency"] for topic in topic_distribution])
-        topic_distribution = [
-            {"name": pos, "frequency": topic["frequency"] * coeff} for pos, topic in enumerate(topic_distribution)
+        return [(row["doc_id"], row["score"]) for row in rows]
+
+    async def get_topic_distribution_by_metadata(self, field, field_value):
+        aggregate = await self.fetchrow(
+            f"SELECT topic_distribution FROM {self.table}_metadata_distributions WHERE field=$1 AND value=$2",
+            field,
+            field_value,
+        )
+        if aggregate is not None:
+            frequencies = self.array_data(aggregate["topic_distribution"])
+            return [{"name": pos, "frequency": float(frequency)} for pos, frequency in enumerate(frequencies)]
+        # Fields that were not aggregated at build time are summed over their documents
+        if field == "year":  # asyncpg does not cast text parameters to the INTEGER year column
+            field_value = int(field_value)
+        rows = await self.fetch(f"SELECT topic_distribution FROM {self.table}_docs WHERE {field}=$1", field_value)
+        distributions = [self.array_data(row["topic_distribution"]) for row in rows]
+        if not distributions:
+            return []
+        frequencies = np.sum(distributions, axis=0, dtype=np.float64)
+        frequencies = frequencies / frequencies.sum()
+        return [{"name": pos, "frequency": float(frequency)} for pos, frequency in enumerate(frequencies)]
+
+    async def get_topic_distributions_over_time(self):
+        rows = await self.fetch(f"SELECT topic_id, topic_evolution FROM {self.table}_topics ORDER BY topic_id asc")
+        return [
+            {"topic": row["topic_id"], "topic_evolution": await self.labeled_array(row["topic_evolution"], "years")}
+            for row in rows
         ]
-        return topic_distribution
-
-    def get_topic_distributions_over_time(self):
-        distributions_over_time = []
-        self.cursor.execute(f"SELECT topic_id, topic_evolution FROM {self.table}_topics ORDER BY topic_id asc")
-        for row in self.cursor:
-            distributions_over_time.append({"topic": row["topic_id"], "topic_evolution": row["topic_evolution"]})
-        return distributions_over_time
@@ -5,9 +5,15 @@ import configparser
 import gc
 import os
 import pickle
+import shutil
 import time
+from glob import escape as glob_escape
+from glob import glob
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
 
 from joblib import dump
+import numpy as np
 from philologic.runtime.DB import DB
 from text_preprocessing import PreProcessor, Token
 from topologic import (
@@ -20,13 +26,19 @@ from topologic import (
     write_app_config,
     year_normalizer,
 )
+from topologic.cache import PreprocessingCache, file_hash, prune_preprocessing_cache
+from topologic.config import METADATA_DISTRIBUTIONS
 from topologic.DB import DBHandler
+from topologic.segments import SegmentWriter, TokenSegmentWriter, convert_text_directory, rebase_segment
+from topologic.vectorization import token_analyzer
 
 GLOBAL_CONFIG = configparser.ConfigParser()
 GLOBAL_CONFIG.read("/etc/topologic/global_settings.ini")
 
 OBJECT_LEVELS = {"doc": 1, "div1": 2, "div2": 3, "div3": 4, "para": 5}
 
+FLOAT32_TOLERANCE = 1e-3  # max deviation of float32 topic distributions from float64, relative to the largest weight
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Define files to process")
@@ -43,9 +55,21 @@ def parse_args():
         type=int,
         default=4,
     )
+    parser.add_argument(
+        "--cache_path",
+        help="path to the persistent preprocessing cache: only new or modified source files are preprocessed again. Set to an empty string to disable",
+        default="./preprocessing_cache",
+        type=str,
+    )
+    parser.add_argument(
+        "--cache_max_size",
+        help="maximum size in GB of the preprocessing cache: least recently used entries are removed beyond it. Set to 0 for no limit",
+        default=20,
+        type=float,
+    )
     parser.add_argument(
         "--preprocessed_data_path",
-        help="skips preprocessing, decompresses preprocessed data from this path, and uses it for model building",
+        help="skips preprocessing and uses the preprocessed data saved at this path for model building",
         type=str,
     )
     parser.add_argument(
@@ -94,8 +118,6 @@ def main(args):
     inference_texts_path = os.path.join(args.data_output, "inference/")
     if os.path.exists(args.data_output) is True and args.preprocessed_data_path is None:
         os.system(f"rm -rf {args.data_output}")
-        os.system(f"mkdir -p {inference_texts_path}")
-        os.system(f"mkdir -p {training_texts_path}")
 
     if args.preprocessed_data_path is None:
         print("## PROCESSING DATA ##", flush=True)
@@ -106,12 +128,22 @@ def main(args):
             inference_config,
             inference_texts_path,
             metadata_filters,
+            workers=args.workers,
+            cache_path=args.cache_path,
+            cache_max_size=args.cache_max_size,
+            token_ids=vector_config["token_ids"],
         )
+    elif os.path.isdir(args.preprocessed_data_path):
+        training_texts_path = os.path.join(args.preprocessed_data_path, "training/")
+        inference_texts_path = os.path.join(args.preprocessed_data_path, "inference/")
     else:
-        # Decompress preprocessed data
+        # Decompress preprocessed data from tarballs made by older versions, which saved one file per text object
         os.system(f"tar -xzf {args.preprocessed_data_path}")
         training_texts_path = os.path.join(args.data_output, "training/")
         inference_texts_path = os.path.join(args.data_output, "inference/")
+        for texts_path in (training_texts_path, inference_texts_path):
+            for text_collection in os.scandir(texts_path):
+                convert_text_directory(text_collection.path)
 
     topic_model, full_corpus, training_corpus = build_model(
         training_texts_path,
@@ -127,6 +159,9 @@ def main(args):
         max_features=vector_config["max_features"] or None,
         ngram=vector_config["ngram"],
         evaluate=args.evaluate,
+        workers=args.workers,
+        streaming=vector_config["streaming"],
+        dtype=np.float32 if vector_config["float32"] is True else np.float64,
     )
 
     if args.evaluate is False:
@@ -140,6 +175,7 @@ def main(args):
         )
     else:
         print("Estimating the number of topics...")
+        os.makedirs(args.data_output, exist_ok=True)  # not created when reusing preprocessed data
         corpus_path = os.path.join(args.data_output, "corpus")
         dump(training_corpus, corpus_path)
         os.system("mkdir -p ./evaluation_output")
@@ -185,6 +221,149 @@ def dictionary_filter(dictionary_file: str, preprocessor: PreProcessor):
     return dictionary
 
 
+def build_preprocessor(prep_config, text_object_level, workers):
+    return PreProcessor(
+        text_object_type=text_object_level,
+        language=prep_config["language"],
+        language_model=prep_config["language_model"],
+        stemmer=prep_config["stemmer"],
+        lemmatizer=prep_config["lemmatizer"],
+        modernize=prep_config["modernize"],
+        lowercase=prep_config["lowercase"],
+        strip_numbers=prep_config["numbers"],
+        stopwords=prep_config["stopwords"],
+        pos_to_keep=prep_config["pos_to_keep"],
+        ner_to_keep=prep_config["ner_to_keep"],
+        ascii=prep_config["ascii"],
+        min_word_length=prep_config["minimum_word_length"],
+        is_philo_db=True,
+        workers=workers,
+        progress=False,
+    )
+
+
+def cached_text_objects(job, cache):
+    """Yield (number of tokens, text, metadata) for each text object, only preprocessing files missing from cache"""
+    text_object_level = job["db_config"]["text_object_level"]
+    file_keys = {file: file_hash(file) for file in job["file_list"]}
+    uncached_files = [file for file, key in file_keys.items() if key not in cache]
+    print(
+        f"{job['progress_prefix']} {len(file_keys) - len(uncached_files)} files reused from preprocessing cache",
+        flush=True,
+    )
+    if uncached_files:
+        preproc = build_preprocessor(job["prep_config"], text_object_level, job["workers"])
+        files_by_doc = {os.path.basename(file).split(".")[0]: file for file in uncached_files}
+        current_file = None
+        text_objects = []
+        for text in preproc.process_texts(uncached_files, progress_prefix=job["progress_prefix"]):
+            source_file = files_by_doc[text.metadata[f"philo_{text_object_level}_id"].split()[0]]
+            if source_file != current_file:  # flush text objects of previous file
+                if text_objects:
+                    cache.extend(file_keys[current_file], text_objects)
+                current_file = source_file
+                text_objects = []
+            text_objects.append((len(text), " ".join(text), text.metadata))
+        if text_objects:
+            cache.extend(file_keys[current_file], text_objects)
+        cache.commit({file_keys[file] for file in uncached_files})
+        preproc = None
+        gc.collect()
+    for file in job["file_list"]:
+        yield from cache.get(file_keys[file])
+
+
+def preprocess_collection(job):
+    """Preprocess one PhiloLogic collection into a segment numbered from 0. Returns the number of texts kept"""
+    db_config = job["db_config"]
+    dictionary = dictionary_filter((job["prep_config"]["dictionary"]), None)
+    if job["cache_path"]:
+        cache = PreprocessingCache(
+            job["cache_path"], job["prep_config"], db_config["text_object_level"], db_config["db_path"]
+        )
+        text_objects = cached_text_objects(job, cache)
+    else:
+        preproc = build_preprocessor(job["prep_config"], db_config["text_object_level"], job["workers"])
+        text_objects = (
+            (len(text), " ".join(text), text.metadata)
+            for text in preproc.process_texts(job["file_list"], progress_prefix=job["progress_prefix"])
+        )
+    metadata = {}
+    pos = 0
+    if job["token_ids"] is True:
+        analyze = token_analyzer()
+        segment = TokenSegmentWriter(job["output_path"])
+    else:
+        segment = SegmentWriter(job["output_path"])
+    for n_tokens, text, text_metadata in text_objects:
+        if (
+            job["min_tokens_per_doc"] > n_tokens
+            or job["philo_ids"]
+            and text_metadata[f"philo_{db_config['text_object_level']}_id"] not in job["philo_ids"]
+        ):
+            continue
+        if dictionary:
+            text = " ".join([t for t in text.split(" ") if t in dictionary])
+        if job["token_ids"] is True:
+            segment.add(pos, analyze(text))
+        else:
+            segment.add(pos, text)
+        if job["keep_metadata"] is True:
+            text_metadata["philo_db"] = job["db_name"]
+            metadata[pos] = text_metadata
+        pos += 1
+    segment.close()
+    with open(os.path.join(job["output_path"], "metadata.pickle"), "wb") as output_metadata:
+        pickle.dump(metadata, output_metadata)
+    preproc = None
+    gc.collect()
+    return pos
+
+
+def preprocess_collections(jobs, workers):
+    """Preprocess collections concurrently within a global budget of workers.
+    Each collection gets a share of workers proportional to its number of files and
+    the largest collections are started first."""
+    if not jobs:
+        return {}
+    total_files = sum(len(job["file_list"]) for job in jobs)
+    for job in jobs:
+        job["workers"] = max(1, min(workers, round(workers * len(job["file_list"]) / total_files)))
+    pending = sorted(jobs, key=lambda job: len(job["file_list"]), reverse=True)
+    running = {}
+    text_counts = {}
+    free_workers = workers
+    with ProcessPoolExecutor(max_workers=min(len(jobs), workers), mp_context=get_context("fork")) as executor:
+        while pending or running:
+            for job in list(pending):
+                if job["workers"] <= free_workers or not running:
+                    pending.remove(job)
+                    free_workers -= job["workers"]
+                    running[executor.submit(preprocess_collection, job)] = job
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                free_workers += job["workers"]
+                text_counts[(job["stage"], job["db_name"])] = future.result()
+    return text_counts
+
+
+def number_collections(stage, texts_path, databases, text_counts):
+    """Shift collection-local document ids so that numbering is global and follows the order of databases"""
+    pos = 0
+    for db_name in databases:
+        if (stage, db_name) not in text_counts:
+            continue
+        if pos > 0:
+            collection_path = os.path.join(texts_path, db_name)
+            rebase_segment(collection_path, pos)
+            with open(os.path.join(collection_path, "metadata.pickle"), "rb") as input_metadata:
+                metadata = pickle.load(input_metadata)
+            with open(os.path.join(collection_path, "metadata.pickle"), "wb") as output_metadata:
+                pickle.dump({doc_id + pos: fields for doc_id, fields in metadata.items()}, output_metadata)
+        pos += text_counts[(stage, db_name)]
+
+
 def prepare_data(
     prep_config,
     training_config,
@@ -192,153 +371,85 @@ def prepare_data(
     inference_config,
     inference_texts_path,
     metadata_filters,
+    workers=4,
+    cache_path="",
+    cache_max_size=0,
+    token_ids=False,
 ):
-    print("Processing training data...", flush=True)
-    count = 0
-    pos = 0
-    for db_name, db_config in training_config["databases"].items():
-        count += 1
-        preproc = PreProcessor(
-            text_object_type=db_config["text_object_level"],
-            language=prep_config["language"],
-            language_model=prep_config["language_model"],
-            stemmer=prep_config["stemmer"],
-            lemmatizer=prep_config["lemmatizer"],
-            modernize=prep_config["modernize"],
-            lowercase=prep_config["lowercase"],
-            strip_numbers=prep_config["numbers"],
-            stopwords=prep_config["stopwords"],
-            pos_to_keep=prep_config["pos_to_keep"],
-            ner_to_keep=prep_config["ner_to_keep"],
-            ascii=prep_config["ascii"],
-            min_word_length=prep_config["minimum_word_length"],
-            is_philo_db=True,
-            workers=args.workers,
-            progress=False,
-        )
-        dictionary = dictionary_filter((prep_config["dictionary"]), preproc)
-        philo_ids = set()
-        if metadata_filters:
-            file_list, philo_ids = get_file_list(
-                os.path.join(db_config["db_path"], "data"),
-                metadata_filters,
-                db_config["text_object_level"],
-                prep_config["minimum_word_length"],
-            )
+    os.makedirs(training_texts_path, exist_ok=True)
+    os.makedirs(inference_texts_path, exist_ok=True)
+    jobs = {"training": [], "inference": []}
+    for stage, stage_config, texts_path in (
+        ("training", training_config, training_texts_path),
+        ("inference", inference_config, inference_texts_path),
+    ):
+        count = 0
+        for db_name, db_config in stage_config["databases"].items():
+            count += 1
+            if stage == "inference" and db_name in training_config["databases"]:
+                if db_config["text_object_level"] == training_config["databases"][db_name]["text_object_level"]:
+                    # relative link so that snapshots of the preprocessed data remain valid
+                    os.symlink(
+                        os.path.relpath(os.path.join(training_texts_path, db_name), inference_texts_path),
+                        os.path.join(inference_texts_path, db_name),
+                    )
+                    continue
+            philo_ids = set()
+            if metadata_filters:
+                file_list, philo_ids = get_file_list(
+                    os.path.join(db_config["db_path"], "data"),
+                    metadata_filters,
+                    db_config["text_object_level"],
+                    prep_config["minimum_word_length"],
+                )
+            else:
+                file_list = [f.path for f in os.scandir(os.path.join(db_config["db_path"], "data/words_and_philo_ids"))]
             file_count = len(file_list)
-        else:
-            file_list = [f.path for f in os.scandir(os.path.join(db_config["db_path"], "data/words_and_philo_ids"))]
-            file_count = len(file_list)
-        metadata = {}
-        if file_count == 0:
-            print(f"Skipping collection {count}... No files matched based on metadata filter.")
-            continue
-
-        os.system(f"mkdir -p {os.path.join(training_texts_path, db_name, 'texts')}")
-        for text in preproc.process_texts(
-            file_list,
-            progress_prefix=f"Processing {file_count} files from collection {count} of {len(training_config['databases'])}...",
-        ):
-            if (
-                training_config["min_tokens_per_doc"] > len(text)
-                or metadata_filters
-                and text.metadata[f"philo_{db_config['text_object_level']}_id"] not in philo_ids
-            ):
+            if file_count == 0:
+                print(f"Skipping {stage} collection {count}... No files matched based on metadata filter.")
                 continue
-            with open(
-                os.path.join(training_texts_path, db_name, "texts", str(pos)), "w", buffering=65536, encoding="utf-8"
-            ) as output:  ## Set buffer to 64K to speed up writes and avoid build-up in RAM
-                if dictionary:
-                    output.write(" ".join([t for t in text if t.text in dictionary]))
-                else:
-                    output.write(" ".join(text))
-            if (
-                db_name in inference_config["databases"]
-                and db_config["text_object_level"] == inference_config["databases"][db_name]["text_object_level"]
-            ):  # if training collection and inference collection are the same, we won't process it again
-                text.metadata["philo_db"] = db_name
-                metadata[pos] = text.metadata
-            pos += 1
-        with open(os.path.join(training_texts_path, db_name, "metadata.pickle"), "wb") as output_metadata:
-            pickle.dump(metadata, output_metadata)
-        preproc = None
-        gc.collect()
-
-    pos = 0
-    count = 0
-    print("Processing inference data...", flush=True)
-    for db_name, db_config in inference_config["databases"].items():
-        count += 1
-        if db_name in training_config["databases"]:
-            if db_config["text_object_level"] == training_config["databases"][db_name]["text_object_level"]:
-                os.system(f"ln -s {os.path.abspath(training_texts_path)}/{db_name} {inference_texts_path}/{db_name}")
-                continue
-        preproc = PreProcessor(
-            text_object_type=db_config["text_object_level"],
-            language=prep_config["language"],
-            language_model=prep_config["language_model"],
-            stemmer=prep_config["stemmer"],
-            lemmatizer=prep_config["lemmatizer"],
-            modernize=prep_config["modernize"],
-            lowercase=prep_config["lowercase"],
-            strip_numbers=prep_config["numbers"],
-            stopwords=prep_config["stopwords"],
-            pos_to_keep=prep_config["pos_to_keep"],
-            ner_to_keep=prep_config["ner_to_keep"],
-            ascii=prep_config["ascii"],
-            min_word_length=prep_config["minimum_word_length"],
-            is_philo_db=True,
-            workers=args.workers,
-            progress=False,
-        )
-        dictionary = dictionary_filter((prep_config["dictionary"]), preproc)
-        philo_ids = set()
-        if metadata_filters:
-            file_list, philo_ids = get_file_list(
-                os.path.join(db_config["db_path"], "data"),
-                metadata_filters,
-                db_config["text_object_level"],
-                prep_config["minimum_word_length"],
+            if stage == "training":
+                # if training collection and inference collection are the same, we won't process it again
+                keep_metadata = (
+                    db_name in inference_config["databases"]
+                    and db_config["text_object_level"] == inference_config["databases"][db_name]["text_object_level"]
+                )
+            else:
+                keep_metadata = True
+            jobs[stage].append(
+                {
+                    "stage": stage,
+                    "db_name": db_name,
+                    "db_config": db_config,
+                    "prep_config": prep_config,
+                    "output_path": os.path.join(texts_path, db_name),
+                    "file_list": file_list,
+                    "philo_ids": philo_ids,
+                    "min_tokens_per_doc": stage_config["min_tokens_per_doc"],
+                    "keep_metadata": keep_metadata,
+                    "cache_path": cache_path,
+                    "token_ids": token_ids,
+                    "progress_prefix": f"Processing {file_count} files from {stage} collection {count} of {len(stage_config['databases'])}...",
+                }
             )
-            file_count = len(philo_ids)
-        else:
-            file_list = [f.path for f in os.scandir(os.path.join(db_config["db_path"], "data/words_and_philo_ids"))]
-            file_count = len(file_list)
-        metadata = {}
-        if file_count == 0:
-            print(f"Skipping collection {count}... No files matched based on metadata filter.")
-            continue
-        os.system(f"mkdir -p {os.path.join(inference_texts_path, db_name, 'texts')}")
-        for text in preproc.process_texts(
-            file_list,
-            progress_prefix=f"Processing {file_count} files from collection {count} of {len(inference_config['databases'])}...",
-        ):
-
-            if (
-                inference_config["min_tokens_per_doc"] > len(text)
-                or metadata_filters
-                and text.metadata[f"philo_{db_config['text_object_level']}_id"] not in philo_ids
-            ):
-                continue
-            with open(
-                os.path.join(inference_texts_path, db_name, "texts", str(pos)), "w", buffering=65536, encoding="utf-8"
-            ) as output:  ## Set buffer to 64K to speed up writes and avoid build-up in RAM
-                if dictionary:
-                    output.write(" ".join([t for t in text if t.text in dictionary]))
-                else:
-                    output.write(" ".join(text))
-            text.metadata["philo_db"] = db_name
-            metadata[pos] = text.metadata
-            pos += 1
-        with open(os.path.join(inference_texts_path, db_name, "metadata.pickle"), "wb") as output_metadata:
-            pickle.dump(metadata, output_metadata)
-        preproc = None
-        gc.collect()
 
-    # Compress data output for if a new model is to be built from the same preprocessed data
-    # Add timestamp to tarball YYYY-MM-DD_HH-MM
-    tarball_name = f"{args.data_output}_{time.strftime('%Y-%m-%d_%H-%M')}.tar.gz"
-    os.system(f"tar -czf {tarball_name} {args.data_output}")
+    print("Processing training and inference data...", flush=True)
+    text_counts = preprocess_collections(jobs["training"] + jobs["inference"], workers)
+    number_collections("training", training_texts_path, training_config["databases"], text_counts)
+    number_collections("inference", inference_texts_path, inference_config["databases"], text_counts)
+    if cache_path and cache_max_size > 0:
+        prune_preprocessing_cache(cache_path, cache_max_size * 1024**3)
+
+    # Snapshot preprocessed data for if a new model is to be built from the same preprocessed data
+    # Segments are never modified once written, so the snapshot hard links them instead of copying when possible
+    # Add timestamp to snapshot YYYY-MM-DD_HH-MM
+    snapshot_path = f"{os.path.normpath(args.data_output)}_{time.strftime('%Y-%m-%d_%H-%M')}"
+    try:
+        shutil.copytree(args.data_output, snapshot_path, symlinks=True, copy_function=os.link)
+    except (OSError, shutil.Error):
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        shutil.copytree(args.data_output, snapshot_path, symlinks=True)
+    print(f"Preprocessed data saved in {snapshot_path}: use --preprocessed_data_path to reuse it", flush=True)
 
 
 def build_model(
@@ -355,6 +466,9 @@ def build_model(
     max_features=None,
     ngram=2,
     evaluate=False,
+    workers=1,
+    streaming=False,
+    dtype=np.float64,
 ):
 
     # Load and prepare a corpus
@@ -366,6 +480,9 @@ def build_model(
         min_absolute_frequency=min_freq,
         ngram=ngram,
         max_features=max_features,
+        workers=workers,
+        streaming=streaming,
+        dtype=dtype,
     )
     print("training corpus size:", training_corpus.size)
     print("vocabulary size:", len(training_corpus.vectorizer.vocabulary_))
@@ -392,6 +509,8 @@ def build_model(
                 max_relative_frequency=training_corpus._max_relative_frequency,
                 min_absolute_frequency=training_corpus._min_absolute_frequency,
                 ngram=training_corpus.ngram,
+                workers=workers,
+                reference_corpus=training_corpus,
             )
     else:
         full_corpus = Corpus(
@@ -400,6 +519,8 @@ def build_model(
             max_relative_frequency=training_corpus._max_relative_frequency,
             min_absolute_frequency=training_corpus._min_absolute_frequency,
             ngram=training_corpus.ngram,
+            workers=workers,
+            reference_corpus=training_corpus,
         )
 
     print("inference corpus size:", full_corpus.size)
@@ -416,10 +537,37 @@ def build_model(
         print("Inferring topics...", flush=True)
         topic_model.infer_topics(num_topics=number_of_topics)
         topic_model.infer_and_replace(full_corpus)
+        if dtype == np.float32:
+            deviation = topic_model.float64_deviation()
+            print(f"float32 deviation from float64 topic distributions: {deviation:.2e}", flush=True)
+            if deviation > FLOAT32_TOLERANCE:
+                print(
+                    f"WARNING: float32 deviation exceeds tolerance of {FLOAT32_TOLERANCE}: consider setting float32 = no",
+                    flush=True,
+                )
 
     return topic_model, full_corpus, training_corpus
 
 
+def publish_web_app(db_path, build_path):
+    """Atomically point db_path to build_path. The previous build is kept for requests still being served
+    from it, and older builds are removed"""
+    previous_build = os.path.realpath(db_path) if os.path.islink(db_path) else None
+    in_place_app = None
+    if os.path.isdir(db_path) and not os.path.islink(db_path):
+        # App built in place by an earlier version: a directory can't be replaced by a symlink in one rename,
+        # so it is moved aside right before the symlink takes its place, and only removed afterwards
+        in_place_app = f"{db_path}.in_place"
+        os.rename(db_path, in_place_app)
+    os.symlink(os.path.basename(build_path), f"{build_path}.link")
+    os.replace(f"{build_path}.link", db_path)
+    if in_place_app is not None:
+        shutil.rmtree(in_place_app, ignore_errors=True)
+    for old_build in glob(f"{glob_escape(db_path)}.[0-9]*"):
+        if old_build not in (build_path, previous_build):
+            shutil.rmtree(old_build, ignore_errors=True)
+
+
 def build_web_app(
     config_path,
     inference_config,
@@ -428,14 +576,15 @@ def build_web_app(
     full_corpus,
     topics_over_time,
 ):
+    # The app is built in a new versioned directory, which only replaces the live one once complete
     db_path = os.path.join(GLOBAL_CONFIG["WEB_APP"]["web_app_path"], database_name)
-    if os.path.exists(db_path) is True:
-        os.system(f"rm -rf {db_path}")
-    os.mkdir(db_path)
-    os.system(f"cp -R /var/lib/topologic/web-app/browser-app/* {db_path}/")
-    os.system(f"cp /var/lib/topologic/web-app/apache_htaccess.conf {db_path}/.htaccess")
+    build_path = f"{db_path}.{time.strftime('%Y-%m-%d_%H-%M-%S')}"
+    os.mkdir(build_path)
+    os.system(f"cp -R /var/lib/topologic/web-app/browser-app/* {build_path}/")
+    os.system(f"cp /var/lib/topologic/web-app/apache_htaccess.conf {build_path}/.htaccess")
     config = configparser.ConfigParser()
     config.read(config_path)
+    compact_arrays = config["DATABASE"].getboolean("compact_arrays", fallback=False)
 
     years = set()
     metadata_field_names = set()
@@ -462,9 +611,10 @@ def build_web_app(
         "num_docs": full_corpus.size,
         "num_tokens": len(full_corpus.vectorizer.vocabulary_),
         "metadata": ",".join(metadata_field_names),
+        "compact_arrays": "yes" if compact_arrays is True else "no",
     }
 
-    with open(os.path.join(db_path, "model_config.ini"), "w", encoding="utf8") as configfile:
+    with open(os.path.join(build_path, "model_config.ini"), "w", encoding="utf8") as configfile:
         config.write(configfile)
 
     db = DBHandler.set_class_attributes(
@@ -475,23 +625,30 @@ def build_web_app(
         min_year,
         max_year,
         topics_over_time["topics_over_time_interval"],
+        compact_arrays=compact_arrays,
     )
     print("Saving words...", flush=True)
-    db.save_words()
+    db.save_words(
+        similar_words=config["DATABASE"].getint("similar_words", fallback=100),
+        docs_per_word=config["DATABASE"].getint("docs_per_word", fallback=100),
+    )
 
     print("Saving docs...", flush=True)
     db.save_docs()
 
     print("Saving topics...", flush=True)
     db.save_topics(
-        f"{db_path}/topic_words.json",
+        f"{build_path}/topic_words.json",
         min_year,
         max_year,
         topics_over_time["topics_over_time_interval"],
     )
 
+    print("Saving topic distributions of metadata values...", flush=True)
+    db.save_metadata_distributions([distribution["field"] for distribution in METADATA_DISTRIBUTIONS])
+
     write_app_config(
-        db_path,
+        build_path,
         database_name,
         GLOBAL_CONFIG["WEB_APP"]["server_name"],
         GLOBAL_CONFIG["WEB_APP"]["proxy_path"],
@@ -500,7 +657,12 @@ def build_web_app(
         max_year,
         topics_over_time["topics_over_time_interval"],
     )
-    os.system(f"cd {db_path}; npm run build")
+    os.system(f"cd {build_path}; npm run build")
+
+    print("Switching to new model...", flush=True)
+    # The app is switched after the tables are renamed and before the renames commit, which leaves a short gap:
+    # an API request that read the previous model_config just before the switch may query the new tables
+    db.publish(switch_app=lambda: publish_web_app(db_path, build_path))
 
     print(
         f"""TopoLogic web application is viewable at: {os.path.join(GLOBAL_CONFIG['WEB_APP']['server_name'], GLOBAL_CONFIG["WEB_APP"]["proxy_path"], 'topologic', os.path.basename(db_path))}"""
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Content-addressed cache of preprocessed text objects, and cache of API responses"""
+
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PHILO_METADATA_STORE = os.path.join("data", "toms.db")  # where PhiloLogic databases keep the metadata of text objects
+
+
+def file_hash(file_path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1048576), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreprocessingCache:
+    """Store the text objects produced by the preprocessor for each source file.
+    Entries are keyed by the hash of the source file, the hash of the preprocessing config and
+    the PhiloLogic database the metadata of text objects is read from, identified by its path and
+    the size and modification time of its metadata store. Any change to one of them results in a
+    cache miss. Each entry is a stream of pickled (number of tokens, text, metadata) tuples, one
+    per text object. Entries are touched when read, so that prune_preprocessing_cache removes the
+    least recently used ones first."""
+
+    def __init__(self, cache_path, prep_config, text_object_level, db_path=None):
+        config = {"preprocessing": prep_config, "text_object_level": text_object_level, "resources": {}}
+        for resource in ("stopwords", "lemmatizer", "dictionary"):  # account for edits to resource files
+            if prep_config.get(resource) and os.path.isfile(prep_config[resource]):
+                config["resources"][resource] = file_hash(prep_config[resource])
+        if db_path is not None:  # account for metadata corrected by reloading the database
+            metadata_store = os.path.join(db_path, PHILO_METADATA_STORE)
+            if os.path.exists(metadata_store):
+                metadata_stat = os.stat(metadata_store)
+                config["database"] = [os.path.realpath(db_path), metadata_stat.st_size, metadata_stat.st_mtime_ns]
+            else:
+                config["database"] = [os.path.realpath(db_path), None, None]
+        config_key = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        self.path = os.path.join(cache_path, config_key)
+        self.pending = {}
+
+    def __entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.exists(self.__entry(key))
+
+    def get(self, key):
+        """Iterate over the cached text objects of a source file"""
+        os.utime(self.__entry(key))
+        with open(self.__entry(key), "rb") as entry:
+            while True:
+                try:
+                    yield pickle.load(entry)
+                except EOFError:
+                    break
+
+    def extend(self, key, text_objects):
+        """Append (number of tokens, text, metadata) tuples to the entry being built for a source file"""
+        if key not in self.pending:
+            os.makedirs(os.path.dirname(self.__entry(key)), exist_ok=True)
+            self.pending[key] = f"{self.__entry(key)}.{os.getpid()}.tmp"
+        with open(self.pending[key], "ab") as entry:
+            for text_object in text_objects:
+                pickle.dump(text_object, entry)
+
+    def commit(self, keys):
+        """Publish entries for source files once they have been fully processed"""
+        for key in keys:
+            if key in self.pending:
+                os.replace(self.pending.pop(key), self.__entry(key))
+            else:  # source file produced no text objects
+                os.makedirs(os.path.dirname(self.__entry(key)), exist_ok=True)
+                open(self.__entry(key), "wb").close()
+
+
+def prune_preprocessing_cache(cache_path, max_size):
+    """Remove the least recently used entries of the preprocessing cache until it holds at most max_size bytes,
+    along with the partial entries that interrupted runs left behind for more than a day"""
+    entries = []
+    for directory, _, file_names in os.walk(cache_path):
+        for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            entry_stat = os.stat(path)
+            if file_name.endswith(".tmp"):
+                if entry_stat.st_mtime < time.time() - 86400:
+                    os.remove(path)
+            else:
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, path))
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if cache_size <= max_size:
+            break
+        os.remove(path)
+        cache_size -= size
+
+
+class ResponseCache:
+    """Bounded LRU cache of JSON responses whose entries expire after ttl seconds. When path is set, entries
+    are also stored in a SQLite file shared by all server workers on the machine. SQLite is only accessed from
+    an executor thread so that it never blocks the event loop, and entries beyond max_size are evicted from it
+    every eviction_interval writes. Callers put the build generation of a model in their keys, so that entries
+    of a previous build are never returned once a new one is published."""
+
+    def __init__(self, max_size=1000, ttl=3600, path=None, eviction_interval=100):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.eviction_interval = eviction_interval
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.db_lock = threading.Lock()
+        self.__db = None
+        self.__db_pid = None
+
+    @staticmethod
+    def key(*parts):
+        return json.dumps(parts, sort_keys=True, default=str)
+
+    def __shared_db(self):
+        """SQLite connection of the current process"""
+        if self.__db_pid != os.getpid():
+            self.__db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS responses(key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self.__db.commit()
+            self.__db_pid = os.getpid()
+        return self.__db
+
+    def __shared_get(self, key):
+        with self.db_lock:
+            return (
+                self.__shared_db()
+                .execute("SELECT value, expires FROM responses WHERE key=? AND expires>?", (key, time.time()))
+                .fetchone()
+            )
+
+    def __shared_set(self, key, value, expires, evict):
+        with self.db_lock:
+            db = self.__shared_db()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, json.dumps(value), expires))
+            if evict is True:
+                db.execute("DELETE FROM responses WHERE expires<=?", (time.time(),))
+                db.execute(
+                    "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY expires DESC LIMIT ?)",
+                    (self.max_size,),
+                )
+            db.commit()
+
+    async def get(self, key):
+        """Cached response for key, or None"""
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.entries.pop(key, None)
+        if self.path:
+            row = await asyncio.get_running_loop().run_in_executor(None, self.__shared_get, key)
+            if row is not None:
+                value = json.loads(row[0])
+                self.__store(key, value, row[1])
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key, value):
+        expires = time.time() + self.ttl
+        self.__store(key, value, expires)
+        if self.path:
+            self.writes += 1
+            evict = self.writes % self.eviction_interval == 0
+            await asyncio.get_running_loop().run_in_executor(None, self.__shared_set, key, value, expires, evict)
+
+    def __store(self, key, value, expires):
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
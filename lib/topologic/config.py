@@ -6,6 +6,10 @@ import os
 import sys
 from typing import Dict, Union
 
+# Metadata fields listed in the web app with the topic distribution of each of their values. These
+# distributions are aggregated for every value when the model is built.
+METADATA_DISTRIBUTIONS = [{"label": "author", "field": "author", "filterFrequency": 1}]
+
 
 def read_config(config_path):
     """Read config file for building the topic model and associated app"""
@@ -88,8 +92,13 @@ def read_config(config_path):
                 vectorization[key] = int(value.strip())
             else:
                 vectorization[key] = None
+        elif key in ("token_ids", "streaming", "float32"):
+            vectorization[key] = value.lower() == "yes" or value.lower() == "true"
         else:
             vectorization[key] = value
+    for key in ("token_ids", "streaming", "float32"):
+        if key not in vectorization:
+            vectorization[key] = False
     topic_modeling = {}
     for key, value in config["TOPIC_MODELING"].items():
         if key in ("number_of_topics", "max_iter"):
@@ -165,7 +174,7 @@ def write_app_config(
                     "startDate": start_date,
                     "endDate": end_date,
                 },
-                "metadataDistributions": [{"label": "author", "field": "author", "filterFrequency": 1}],
+                "metadataDistributions": METADATA_DISTRIBUTIONS,
             },
             app_config,
             indent=4,
@@ -6,37 +6,84 @@ import pickle
 import random
 from math import floor
 
+import numpy as np
 from annoy import AnnoyIndex
 from multiprocess import cpu_count
+from scipy.sparse import vstack
 from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from tqdm import tqdm
 
+from topologic.segments import TokenSegmentReader, is_segment, open_segment
+from topologic.vectorization import (
+    fit_transform_sharded,
+    fit_transform_streaming,
+    fit_transform_token_ids,
+    supports_token_ids,
+    transform_sharded,
+    transform_token_ids,
+)
+
 
 class savedTexts:
-    def __init__(self, text_path):
+    def __init__(self, text_path, exclude=()):
         self.text_path = text_path
-        self.number_of_texts = 0
-        for text_collection in os.scandir(text_path):
-            self.number_of_texts += len(os.listdir(text_collection.path + "/texts"))
+        self.collections = [
+            open_segment(text_collection.path)
+            for text_collection in sorted(os.scandir(text_path), key=lambda x: x.name)
+            if is_segment(text_collection.path) and os.path.realpath(text_collection.path) not in exclude
+        ]
+        self.token_ids = bool(self.collections) and all(
+            isinstance(collection, TokenSegmentReader) for collection in self.collections
+        )
+        if self.collections:
+            doc_ids = np.concatenate([collection.doc_ids for collection in self.collections])
+            collection_ids = np.concatenate(
+                [np.full(len(collection), i, dtype=np.int32) for i, collection in enumerate(self.collections)]
+            )
+            positions = np.concatenate([np.arange(len(collection)) for collection in self.collections])
+        else:
+            doc_ids = collection_ids = positions = np.zeros(0, dtype=np.int64)
+        self.order = np.argsort(doc_ids, kind="stable")  # document order over collections stacked one after the other
+        self.doc_ids = doc_ids[self.order]
+        self.__collection_ids = collection_ids[self.order]
+        self.__positions = positions[self.order]
+        self.number_of_texts = len(self.doc_ids)
+
+    def __len__(self):
+        return self.number_of_texts
 
     def __iter__(self):
-        files = []
-        for text_collection in os.scandir(self.text_path):
-            for input_file in os.scandir(os.path.join(text_collection.path, "texts")):
-                files.append((input_file.path, int(input_file.name)))
-        files.sort(key=lambda x: x[1])
-        for file, _ in files:
-            with open(file, encoding="utf8") as input_file:
-                text = input_file.read()
-                yield text
+        return self.iterate()
+
+    def iterate(self, start=0, stop=None):
+        """Iterate over texts from position start to stop in document id order"""
+        for collection_id, position in zip(self.__collection_ids[start:stop], self.__positions[start:stop]):
+            yield self.collections[collection_id][position]
+
+    def text_at(self, row):
+        """Get text by its position in document id order"""
+        return self.collections[self.__collection_ids[row]][self.__positions[row]]
+
+    def collection_rows(self, collection_id):
+        """Rows in document id order of a collection's texts, indexed by their position in the collection"""
+        in_collection = self.__collection_ids == collection_id
+        rows = np.empty(len(self.collections[collection_id]), dtype=np.int64)
+        rows[self.__positions[in_collection]] = np.flatnonzero(in_collection)
+        return rows
+
+    def get_text(self, doc_id):
+        for collection in self.collections:
+            try:
+                return collection.get(doc_id)
+            except KeyError:
+                continue
+        raise KeyError(doc_id)
 
     def random_sample(self, proportion=0.8):
-        for text_collection in os.scandir(self.text_path):
-            sample_size = floor(len(os.listdir(text_collection.path + "/texts")) * proportion)
-            for file in random.sample([f.path for f in os.scandir(self.text_path)], sample_size):
-                with open(file, encoding="utf8") as input_file:
-                    text = input_file.read()
-                    yield text
+        for collection in self.collections:
+            sample_size = floor(len(collection) * proportion)
+            for position in random.sample(range(len(collection)), sample_size):
+                yield collection[position]
 
 
 class Corpus:
@@ -50,6 +97,11 @@ class Corpus:
         min_absolute_frequency=0,
         max_features=None,
         vectorizer=None,
+        workers=1,
+        streaming=False,
+        max_terms_in_memory=5000000,
+        reference_corpus=None,
+        dtype=np.float64,
     ):
 
         self._source_files = source_files_path
@@ -73,6 +125,7 @@ class Corpus:
                     max_features=self.max_features,
                     smooth_idf=True,
                     sublinear_tf=True,
+                    dtype=dtype,
                 )
             elif vectorization == "tf":
                 self.vectorizer = CountVectorizer(
@@ -80,24 +133,81 @@ class Corpus:
                     max_df=max_relative_frequency,
                     min_df=min_absolute_frequency,
                     max_features=self.max_features,
+                    dtype=dtype,
                 )
             else:
                 raise ValueError("Unknown vectorization type: %s" % vectorization)
-            self.sklearn_vector_space = self.vectorizer.fit_transform(t for t in self.texts_to_vectorize)
+            if supports_token_ids(self.texts_to_vectorize, self.vectorizer):
+                self.sklearn_vector_space = fit_transform_token_ids(self.vectorizer, self.texts_to_vectorize)
+            elif streaming is True:
+                self.sklearn_vector_space = fit_transform_streaming(
+                    self.vectorizer, self.texts_to_vectorize, workers, max_terms_in_memory
+                )
+            elif workers > 1:
+                self.sklearn_vector_space = fit_transform_sharded(self.vectorizer, self.texts_to_vectorize, workers)
+            else:
+                self.sklearn_vector_space = self.vectorizer.fit_transform(t for t in self.texts_to_vectorize)
         else:
             self.vectorizer = vectorizer
-            self.sklearn_vector_space = self.vectorizer.transform(t for t in self.texts_to_vectorize)
+            if (
+                reference_corpus is not None
+                and reference_corpus.vectorizer is vectorizer
+                and reference_corpus.size == len(reference_corpus.texts_to_vectorize)  # not resampled
+            ):
+                self.sklearn_vector_space = self.__reuse_vectors(reference_corpus, workers)
+            else:
+                self.sklearn_vector_space = self.__transform(self.texts_to_vectorize, workers)
         self.size = self.sklearn_vector_space.shape[0]
         self.feature_names = self.vectorizer.get_feature_names_out()
         self.annoy_index = None
 
+    def __transform(self, texts, workers):
+        if supports_token_ids(texts, self.vectorizer):
+            return transform_token_ids(self.vectorizer, texts)
+        if workers > 1:
+            return transform_sharded(self.vectorizer, texts, workers)
+        return self.vectorizer.transform(t for t in texts)
+
+    def __reuse_vectors(self, reference_corpus, workers):
+        """Take the rows of collections already vectorized in reference_corpus (same files, possibly
+        through a symlink) and only transform the texts of the other collections"""
+        reference_texts = reference_corpus.texts_to_vectorize
+        reference_collections = {
+            os.path.realpath(collection.collection_path): collection_id
+            for collection_id, collection in enumerate(reference_texts.collections)
+        }
+        source_rows = np.full(len(self.texts_to_vectorize), -1, dtype=np.int64)
+        for collection_id, collection in enumerate(self.texts_to_vectorize.collections):
+            reference_id = reference_collections.get(os.path.realpath(collection.collection_path))
+            if reference_id is not None:
+                source_rows[self.texts_to_vectorize.collection_rows(collection_id)] = reference_texts.collection_rows(
+                    reference_id
+                )
+        new_rows = source_rows == -1
+        if not new_rows.any():
+            if np.array_equal(source_rows, np.arange(reference_corpus.size)):
+                return reference_corpus.sklearn_vector_space
+            return reference_corpus.sklearn_vector_space[source_rows]
+        new_texts = savedTexts(self._source_files, exclude=set(reference_collections))
+        print(f"Reusing {len(source_rows) - new_rows.sum()} vectors, transforming {len(new_texts)} new texts", flush=True)
+        # new texts keep their relative document order, so they map to rows of the new matrix in sequence
+        source_rows[new_rows] = reference_corpus.size + np.arange(new_rows.sum())
+        return vstack([reference_corpus.sklearn_vector_space, self.__transform(new_texts, workers)], format="csr")[
+            source_rows
+        ]
+
     def __get_metadata(self, data_path):
         metadata = {}
         for text_collection in os.scandir(data_path):
+            if not is_segment(text_collection.path):
+                continue
             with open(os.path.join(text_collection.path, "metadata.pickle"), "rb") as metadata_file:
                 metadata.update(pickle.load(metadata_file))
         return metadata
 
+    def text_for_document(self, doc_id):
+        return self.texts_to_vectorize.get_text(doc_id)
+
     def sample_corpus(self):
         self.sklearn_vector_space = self.vectorizer.transform(t for t in self.texts_to_vectorize.random_sample())
 
@@ -111,7 +221,7 @@ class Corpus:
             leave=False,
         ):
             self.annoy_index.add_item(i, doc_vector[0].toarray()[0])
-        self.annoy_index.build(1000, n_jobs=cpu_count() - 1)
+        self.annoy_index.build(1000, n_jobs=max(cpu_count() - 1, 1))
 
     def docs_for_word(self, word_id):
         ids = []
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Append-only segment store for preprocessed text objects.
+
+Each collection directory holds one segment file with all its texts concatenated
+and an index file of (doc_id, offset, length) int64 triples, one per text object.
+Segments are memory-mapped on read so texts can be streamed sequentially or fetched
+by document id without one open() per document.
+
+Token segments store each text object as an array of uint32 token ids instead of a
+string, with offsets and lengths counted in tokens. Ids index into the collection's
+vocabulary file, which lists one token per line.
+"""
+
+import mmap
+import os
+import shutil
+from array import array
+
+import numpy as np
+
+SEGMENT_FILE = "texts.seg"
+INDEX_FILE = "texts.idx"
+TOKEN_SEGMENT_FILE = "tokens.seg"
+TOKEN_INDEX_FILE = "tokens.idx"
+VOCABULARY_FILE = "vocabulary.txt"
+LEGACY_TEXTS_DIRECTORY = "texts"
+
+
+class SegmentWriter:
+    """Append text objects to a collection segment and record their offsets in the index"""
+
+    def __init__(self, collection_path):
+        os.makedirs(collection_path, exist_ok=True)
+        segment_path = os.path.join(collection_path, SEGMENT_FILE)
+        self.offset = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+        self.segment = open(segment_path, "ab", buffering=1048576)
+        self.index = open(os.path.join(collection_path, INDEX_FILE), "ab", buffering=65536)
+
+    def add(self, doc_id, text):
+        encoded_text = text.encode("utf-8")
+        self.segment.write(encoded_text)
+        array("q", (doc_id, self.offset, len(encoded_text))).tofile(self.index)
+        self.offset += len(encoded_text)
+
+    def close(self):
+        self.segment.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class SegmentReader:
+    """Memory-mapped reader over a collection segment. Texts are ordered by document id"""
+
+    index_file = INDEX_FILE
+
+    def __init__(self, collection_path):
+        self.collection_path = collection_path
+        self._load()
+
+    def _load_index(self):
+        index = np.fromfile(os.path.join(self.collection_path, self.index_file), dtype=np.int64).reshape(-1, 3)
+        index = index[np.argsort(index[:, 0], kind="stable")]
+        self.doc_ids = np.ascontiguousarray(index[:, 0])
+        self.offsets = np.ascontiguousarray(index[:, 1])
+        self.lengths = np.ascontiguousarray(index[:, 2])
+
+    def _load(self):
+        self._load_index()
+        self.segment = None
+        if os.path.getsize(os.path.join(self.collection_path, SEGMENT_FILE)) > 0:
+            with open(os.path.join(self.collection_path, SEGMENT_FILE), "rb") as segment_file:
+                self.segment = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, position):
+        """Get text at position (in document id order)"""
+        if self.lengths[position] == 0:
+            return ""
+        offset = self.offsets[position]
+        return self.segment[offset : offset + self.lengths[position]].decode("utf-8")
+
+    def __iter__(self):
+        for position in range(len(self.doc_ids)):
+            yield self[position]
+
+    def position(self, doc_id):
+        position = int(np.searchsorted(self.doc_ids, doc_id))
+        if position == len(self.doc_ids) or self.doc_ids[position] != doc_id:
+            raise KeyError(doc_id)
+        return position
+
+    def get(self, doc_id):
+        """Get text by document id"""
+        return self[self.position(doc_id)]
+
+    def __getstate__(self):
+        return {"collection_path": self.collection_path}
+
+    def __setstate__(self, state):
+        self.collection_path = state["collection_path"]
+        self._load()
+
+
+class TokenSegmentWriter:
+    """Append text objects as arrays of token ids to a collection segment"""
+
+    def __init__(self, collection_path):
+        os.makedirs(collection_path, exist_ok=True)
+        self.collection_path = collection_path
+        segment_path = os.path.join(collection_path, TOKEN_SEGMENT_FILE)
+        self.offset = os.path.getsize(segment_path) // 4 if os.path.exists(segment_path) else 0
+        self.vocabulary = {}
+        if os.path.exists(os.path.join(collection_path, VOCABULARY_FILE)):
+            with open(os.path.join(collection_path, VOCABULARY_FILE), encoding="utf-8") as vocabulary_file:
+                for token in vocabulary_file:
+                    self.vocabulary[token.rstrip("\n")] = len(self.vocabulary)
+        self.segment = open(segment_path, "ab", buffering=1048576)
+        self.index = open(os.path.join(collection_path, TOKEN_INDEX_FILE), "ab", buffering=65536)
+
+    def add(self, doc_id, tokens):
+        token_ids = array("I", [self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokens])
+        token_ids.tofile(self.segment)
+        array("q", (doc_id, self.offset, len(token_ids))).tofile(self.index)
+        self.offset += len(token_ids)
+
+    def close(self):
+        self.segment.close()
+        self.index.close()
+        with open(os.path.join(self.collection_path, VOCABULARY_FILE), "w", encoding="utf-8") as vocabulary_file:
+            for token in self.vocabulary:  # dicts keep insertion order, which is token id order
+                vocabulary_file.write(f"{token}\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class TokenSegmentReader(SegmentReader):
+    """Memory-mapped reader over a collection token segment. Texts are rebuilt from token ids on access"""
+
+    index_file = TOKEN_INDEX_FILE
+
+    def _load(self):
+        self._load_index()
+        with open(os.path.join(self.collection_path, VOCABULARY_FILE), encoding="utf-8") as vocabulary_file:
+            self.vocabulary = np.array([token.rstrip("\n") for token in vocabulary_file], dtype=str)
+        if os.path.getsize(os.path.join(self.collection_path, TOKEN_SEGMENT_FILE)) > 0:
+            self.tokens = np.memmap(os.path.join(self.collection_path, TOKEN_SEGMENT_FILE), dtype=np.uint32, mode="r")
+        else:
+            self.tokens = np.zeros(0, dtype=np.uint32)
+
+    def token_ids(self, position):
+        offset = self.offsets[position]
+        return self.tokens[offset : offset + self.lengths[position]]
+
+    def __getitem__(self, position):
+        return " ".join(self.vocabulary[self.token_ids(position)])
+
+
+def open_segment(collection_path):
+    """Open a reader for the segment stored in collection_path, if any"""
+    if os.path.exists(os.path.join(collection_path, TOKEN_INDEX_FILE)):
+        return TokenSegmentReader(collection_path)
+    if os.path.exists(os.path.join(collection_path, INDEX_FILE)):
+        return SegmentReader(collection_path)
+    return None
+
+
+def is_segment(collection_path):
+    return os.path.exists(os.path.join(collection_path, INDEX_FILE)) or os.path.exists(
+        os.path.join(collection_path, TOKEN_INDEX_FILE)
+    )
+
+
+def rebase_segment(collection_path, base):
+    """Shift all document ids of a collection segment by base"""
+    index_path = os.path.join(collection_path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        index_path = os.path.join(collection_path, TOKEN_INDEX_FILE)
+    index = np.fromfile(index_path, dtype=np.int64).reshape(-1, 3)
+    index[:, 0] += base
+    index.tofile(f"{index_path}.tmp")
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def convert_text_directory(collection_path):
+    """Convert a collection saved by older versions, with one file per text object named after its document id
+    in a texts directory, into a segment. Returns False if collection_path has no such directory"""
+    texts_path = os.path.join(collection_path, LEGACY_TEXTS_DIRECTORY)
+    if not os.path.isdir(texts_path):
+        return False
+    for file_name in (SEGMENT_FILE, INDEX_FILE):  # left by an interrupted conversion
+        if os.path.exists(os.path.join(collection_path, file_name)):
+            os.remove(os.path.join(collection_path, file_name))
+    with SegmentWriter(collection_path) as segment:
+        for doc_id in sorted(int(text_file.name) for text_file in os.scandir(texts_path)):
+            with open(os.path.join(texts_path, str(doc_id)), encoding="utf8") as input_file:
+                segment.add(doc_id, input_file.read())
+    shutil.rmtree(texts_path)
+    return True
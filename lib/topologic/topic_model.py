@@ -1,21 +1,45 @@
 #!/usr/bin/env python3
 
-import itertools
+import copy
+import random
 from abc import ABCMeta, abstractmethod
 
 import numpy as np
 from annoy import AnnoyIndex
 from multiprocess import cpu_count
-from scipy.sparse import coo_matrix
 from sklearn.decomposition import NMF
 from sklearn.decomposition import LatentDirichletAllocation as LDA
 from sklearn.metrics import pairwise_distances
 from tqdm import tqdm
 
 
+def top_k_columns(matrix, k, block_size=16):
+    """Column indices of the k largest values of each row of matrix, by decreasing value (ties by column).
+    Rows are processed in blocks to bound the size of temporary copies"""
+    k = min(k, matrix.shape[1])
+    top_k = np.zeros((matrix.shape[0], k), dtype=np.int64)
+    for start in range(0, matrix.shape[0], block_size):
+        block = np.asarray(matrix[start : start + block_size])
+        candidates = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        values = np.take_along_axis(block, candidates, axis=1)
+        # argpartition picks arbitrarily among values equal to the k-th largest: keep the first columns instead
+        thresholds = values.min(axis=1, keepdims=True)
+        tied_rows = np.flatnonzero((block == thresholds).sum(axis=1) > (values == thresholds).sum(axis=1))
+        for row in tied_rows:
+            above = np.flatnonzero(block[row] > thresholds[row])
+            candidates[row] = np.concatenate((above, np.flatnonzero(block[row] == thresholds[row])[: k - len(above)]))
+            values[row] = block[row, candidates[row]]
+        order = np.lexsort((candidates, -values), axis=1)
+        top_k[start : start + block_size] = np.take_along_axis(candidates, order, axis=1)
+    return top_k
+
+
 class TopicModel(object):
     __metaclass__ = ABCMeta
 
+    top_k_words = 100  # words per topic kept in the top-k cache
+    top_k_documents = 1000  # documents per topic kept in the top-k cache
+
     def __init__(self, corpus, max_iter=None):
         self.corpus = corpus  # a Corpus object
         self.document_topic_matrix = None  # document x topic matrix
@@ -24,44 +48,26 @@ class TopicModel(object):
         self.model = None
         self.max_iter = max_iter
         self.annoy_index = None
+        self.top_word_ids = None  # topic x top_k_words matrix of word ids
+        self.top_document_ids = None  # topic x top_k_documents matrix of document ids, set by infer_and_replace
 
     @abstractmethod
     def infer_topics(self, num_topics=10, **kwargs):
         pass
 
+    def _set_matrices(self, topic_document):
+        """Keep the dense topic x word and document x topic matrices produced by the model"""
+        self.topic_word_matrix = np.asarray(self.model.components_)
+        self.document_topic_matrix = np.asarray(topic_document)
+        self.top_word_ids = top_k_columns(self.topic_word_matrix, self.top_k_words)
+
     def infer_and_replace(self, corpus):
         """Replace resulting matrices from training with full corpus"""
         self.corpus = corpus
-        topic_document = self.model.transform(corpus.sklearn_vector_space)
-        self.topic_word_matrix = []
-        self.document_topic_matrix = []
-        vocabulary_size = len(self.corpus.vectorizer.vocabulary_)
-        row = []
-        col = []
-        data = []
-        for topic_idx, topic in enumerate(self.model.components_):
-            for i in range(vocabulary_size):
-                row.append(topic_idx)
-                col.append(i)
-                data.append(topic[i])
-        self.topic_word_matrix = coo_matrix(
-            (data, (row, col)), shape=(self.nb_topics, len(self.corpus.vectorizer.vocabulary_))
-        ).tocsr()
-        row = []
-        col = []
-        data = []
-        doc_count = 0
-        for doc in topic_document:
-            topic_count = 0
-            for topic_weight in doc:
-                row.append(doc_count)
-                col.append(topic_count)
-                data.append(topic_weight)
-                topic_count += 1
-            doc_count += 1
-        self.document_topic_matrix = coo_matrix((data, (row, col)), shape=(self.corpus.size, self.nb_topics)).tocsr()
-        topic_frequencies = np.sum(self.document_topic_matrix.transpose(), axis=1)
-        self.topic_frequencies = topic_frequencies / np.sum(topic_frequencies)
+        self._set_matrices(self.model.transform(corpus.sklearn_vector_space))
+        self.top_document_ids = top_k_columns(self.document_topic_matrix.T, self.top_k_documents)
+        topic_frequencies = self.document_topic_matrix.sum(axis=0)
+        self.topic_frequencies = topic_frequencies / topic_frequencies.sum()
         self.annoy_index = AnnoyIndex(self.document_topic_matrix.shape[1], "angular")
         for i, doc_vector in tqdm(
             enumerate(self.document_topic_matrix),
@@ -69,47 +75,58 @@ class TopicModel(object):
             desc="Building Annoy index of document-topic vectors",
             leave=False,
         ):
-            self.annoy_index.add_item(i, doc_vector[0].toarray()[0])
-        self.annoy_index.build(1000, n_jobs=cpu_count() - 1)
+            self.annoy_index.add_item(i, doc_vector)
+        self.annoy_index.build(1000, n_jobs=max(cpu_count() - 1, 1))
+
+    def float64_deviation(self, sample_size=1000):
+        """Largest difference between the document-topic distributions of a sample of documents and
+        those inferred again with the model and document vectors in float64, relative to the largest weight"""
+        rows = sorted(random.sample(range(self.corpus.size), min(sample_size, self.corpus.size)))
+        vectorizer = copy.deepcopy(self.corpus.vectorizer)
+        vectorizer.dtype = np.float64
+        if hasattr(vectorizer, "idf_"):
+            vectorizer.idf_ = vectorizer.idf_.astype(np.float64)
+        vectors = vectorizer.transform(self.corpus.texts_to_vectorize.text_at(row) for row in rows)
+        model = copy.deepcopy(self.model)
+        for attribute, value in vars(model).items():
+            if isinstance(value, np.ndarray) and value.dtype == np.float32:
+                setattr(model, attribute, value.astype(np.float64))
+        reference = model.transform(vectors)
+        return float(np.abs(self.document_topic_matrix[rows] - reference).max() / np.abs(reference).max())
 
     def most_similar_topic_by_doc_distribution(self):
         return pairwise_distances(self.document_topic_matrix.transpose())
 
     def top_words(self, topic_id, num_words):
         vector = self.topic_word_matrix[topic_id]
-        cx = vector.tocoo()
-        weighted_words = [()] * len(self.corpus.vectorizer.vocabulary_)
-        for word_id, weight in itertools.zip_longest(cx.col, cx.data):
-            weighted_words[word_id] = (self.corpus.feature_names[word_id], weight)
-        weighted_words.sort(key=lambda x: x[1], reverse=True)
-        return weighted_words[:num_words]
+        if num_words <= self.top_word_ids.shape[1]:
+            word_ids = self.top_word_ids[topic_id, :num_words]
+        else:
+            word_ids = np.argsort(-vector, kind="stable")[:num_words]
+        return [(self.corpus.feature_names[word_id], vector[word_id]) for word_id in word_ids]
 
     def top_documents(self, topic_id, num_docs=None):
         vector = self.document_topic_matrix[:, topic_id]
-        cx = vector.tocoo()
-        weighted_docs = [()] * self.corpus.size
-        for doc_id, topic_id, weight in itertools.zip_longest(cx.row, cx.col, cx.data):
-            weighted_docs[doc_id] = (doc_id, weight)
-        weighted_docs.sort(key=lambda x: x[1], reverse=True)
-        if num_docs is not None:
-            return weighted_docs[:num_docs]
+        if self.top_document_ids is not None and num_docs is not None and num_docs <= self.top_document_ids.shape[1]:
+            doc_ids = self.top_document_ids[topic_id, :num_docs]
+        elif num_docs is not None:
+            doc_ids = np.argsort(-vector, kind="stable")[:num_docs]
         else:
-            return [d for d in weighted_docs if d[1] > 0]
+            doc_ids = np.flatnonzero(vector > 0)
+            doc_ids = doc_ids[np.argsort(-vector[doc_ids], kind="stable")]
+        return [(doc_id, vector[doc_id]) for doc_id in doc_ids]
 
     def word_distribution_for_topic(self, topic_id):
-        vector = self.topic_word_matrix[topic_id].toarray()
-        return vector[0]
+        return self.topic_word_matrix[topic_id]
 
     def topic_distribution_for_document(self, doc_id):
-        vector = self.document_topic_matrix[doc_id].toarray()
-        return vector[0]
+        return self.document_topic_matrix[doc_id]
 
     def topic_distribution_for_word(self, word_id):
-        vector = self.topic_word_matrix[:, word_id].toarray()
-        return vector.T[0]
+        return self.topic_word_matrix[:, word_id]
 
     def get_topic_frequency(self, topic_id):
-        return self.topic_frequencies[topic_id, 0]
+        return self.topic_frequencies[topic_id]
 
     def most_likely_topics_for_document(self, doc_id):
         topic_vector = self.topic_distribution_for_document(doc_id)
@@ -121,8 +138,6 @@ class TopicModel(object):
 class LatentDirichletAllocation(TopicModel):
     def infer_topics(self, num_topics=10, algorithm="variational", **kwargs):
         self.nb_topics = num_topics
-        lda_model = None
-        topic_document = None
         self.model = LDA(
             n_components=num_topics,
             learning_method="batch",
@@ -132,34 +147,7 @@ class LatentDirichletAllocation(TopicModel):
             doc_topic_prior=1.0 / num_topics,
             topic_word_prior=0.01 / num_topics,
         )
-        topic_document = self.model.fit_transform(self.corpus.sklearn_vector_space)
-        self.topic_word_matrix = []
-        self.document_topic_matrix = []
-        vocabulary_size = len(self.corpus.vectorizer.vocabulary_)
-        row = []
-        col = []
-        data = []
-        for topic_idx, topic in enumerate(self.model.components_):
-            for i in range(vocabulary_size):
-                row.append(topic_idx)
-                col.append(i)
-                data.append(topic[i])
-        self.topic_word_matrix = coo_matrix(
-            (data, (row, col)), shape=(self.nb_topics, len(self.corpus.vectorizer.vocabulary_))
-        ).tocsr()
-        row = []
-        col = []
-        data = []
-        doc_count = 0
-        for doc in topic_document:
-            topic_count = 0
-            for topic_weight in doc:
-                row.append(doc_count)
-                col.append(topic_count)
-                data.append(topic_weight)
-                topic_count += 1
-            doc_count += 1
-        self.document_topic_matrix = coo_matrix((data, (row, col)), shape=(self.corpus.size, self.nb_topics)).tocsr()
+        self._set_matrices(self.model.fit_transform(self.corpus.sklearn_vector_space))
 
 
 class NonNegativeMatrixFactorization(TopicModel):
@@ -175,30 +163,4 @@ class NonNegativeMatrixFactorization(TopicModel):
             random_state=0,
             verbose=True,
         )
-        topic_document = self.model.fit_transform(self.corpus.sklearn_vector_space)
-        self.topic_word_matrix = []
-        self.document_topic_matrix = []
-        vocabulary_size = len(self.corpus.vectorizer.vocabulary_)
-        row = []
-        col = []
-        data = []
-        for topic_idx, topic in enumerate(self.model.components_):
-            for i in range(vocabulary_size):
-                row.append(topic_idx)
-                col.append(i)
-                data.append(topic[i])
-        self.topic_word_matrix = coo_matrix(
-            (data, (row, col)), shape=(self.nb_topics, len(self.corpus.vectorizer.vocabulary_))
-        ).tocsr()
-        row = []
-        col = []
-        data = []
-        doc_count = 0
-        for doc in topic_document:
-            topic_count = 0
-            for topic_weight in doc:
-                row.append(doc_count)
-                col.append(topic_count)
-                data.append(topic_weight)
-                topic_count += 1
-            doc_count += 1
+        self._set_matrices(self.model.fit_transform(self.corpus.sklearn_vector_space))
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""Build document-term matrices faster, or in less memory, than a single vectorizer.fit_transform call.
+
+These functions fit or apply a CountVectorizer/TfidfVectorizer either from token segments,
+where n-grams are counted as integer keys and assembled straight into CSR matrices, by
+counting shards of the corpus in parallel and merging them, or in two streaming passes
+that never hold the unpruned vocabulary in memory. Vocabulary pruning and TF-IDF
+weighting follow sklearn so results match vectorizer.fit_transform.
+"""
+
+import heapq
+import os
+import tempfile
+from collections import Counter
+from numbers import Integral
+
+import numpy as np
+from multiprocess import Pool
+from scipy.sparse import csr_matrix, hstack, vstack
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+
+def token_analyzer():
+    """Tokenize texts the same way as the Corpus vectorizers"""
+    return CountVectorizer().build_analyzer()
+
+
+def supports_token_ids(texts, vectorizer):
+    """N-gram keys are packed into int64, which bounds the vocabulary size for a given n-gram range"""
+    if not texts.token_ids:
+        return False
+    vocabulary_size = len(shared_vocabulary(texts))
+    return vocabulary_size ** vectorizer.ngram_range[1] < 2**63
+
+
+def shared_vocabulary(texts):
+    """Sorted union of the vocabularies of all collections"""
+    return np.unique(np.concatenate([collection.vocabulary for collection in texts.collections]))
+
+
+def token_stream(texts, vocabulary):
+    """Concatenate token ids of all documents in document id order, mapped onto the shared vocabulary.
+    Returns the token ids and the number of tokens per document"""
+    streams = []
+    lengths = []
+    for collection in texts.collections:
+        remap = np.searchsorted(vocabulary, collection.vocabulary)
+        starts = np.cumsum(collection.lengths) - collection.lengths
+        if np.array_equal(collection.offsets, starts):  # texts were written in document order
+            token_ids = collection.tokens[: collection.lengths.sum()]
+        else:
+            token_ids = collection.tokens[
+                np.repeat(collection.offsets - starts, collection.lengths) + np.arange(collection.lengths.sum())
+            ]
+        streams.append(remap[token_ids])
+        lengths.append(collection.lengths)
+    stream = np.concatenate(streams)
+    stacked_lengths = np.concatenate(lengths)
+    lengths = stacked_lengths[texts.order]
+    stacked_starts = np.cumsum(stacked_lengths) - stacked_lengths
+    starts = np.cumsum(lengths) - lengths
+    if not np.array_equal(stacked_starts[texts.order], starts):  # collections are not in document id order
+        stream = stream[np.repeat(stacked_starts[texts.order] - starts, lengths) + np.arange(lengths.sum())]
+    return stream, lengths
+
+
+def ngram_counts(stream, lengths, vocabulary_size, n, dtype):
+    """Count n-grams per document. Returns the sorted n-gram keys and a documents x keys count matrix"""
+    position_in_doc = np.arange(len(stream)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    start_positions = np.flatnonzero(position_in_doc <= np.repeat(lengths, lengths) - n)
+    keys = np.zeros(len(start_positions), dtype=np.int64)
+    for i in range(n):
+        keys = keys * vocabulary_size + stream[start_positions + i]
+    unique_keys, columns = np.unique(keys, return_inverse=True)
+    indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.maximum(lengths - n + 1, 0), out=indptr[1:])
+    counts = csr_matrix(
+        (np.ones(len(columns), dtype=dtype), columns.ravel(), indptr), shape=(len(lengths), len(unique_keys))
+    )
+    counts.sum_duplicates()
+    return unique_keys, counts
+
+
+def ngram_names(keys, vocabulary, n):
+    """Rebuild n-gram strings from their keys"""
+    names = None
+    for _ in range(n):
+        keys, token_ids = np.divmod(keys, len(vocabulary))
+        if names is None:
+            names = vocabulary[token_ids]
+        else:
+            names = np.char.add(np.char.add(vocabulary[token_ids], " "), names)
+    return names
+
+
+def ngram_keys(names, vocabulary):
+    """Convert n-gram strings into keys. Returns -1 for n-grams with a token missing from vocabulary"""
+    keys = np.zeros(len(names), dtype=np.int64)
+    for i, tokens in enumerate(names):
+        key = 0
+        for token in tokens.split(" "):
+            token_id = np.searchsorted(vocabulary, token)
+            if token_id == len(vocabulary) or vocabulary[token_id] != token:
+                key = -1
+                break
+            key = key * len(vocabulary) + int(token_id)
+        keys[i] = key
+    return keys
+
+
+def document_count_bounds(vectorizer, n_docs):
+    max_doc_count = vectorizer.max_df if isinstance(vectorizer.max_df, Integral) else vectorizer.max_df * n_docs
+    min_doc_count = vectorizer.min_df if isinstance(vectorizer.min_df, Integral) else vectorizer.min_df * n_docs
+    if max_doc_count < min_doc_count:
+        raise ValueError("max_df corresponds to < documents than min_df")
+    return max_doc_count, min_doc_count
+
+
+def prune_features(document_frequencies, term_frequencies, n_docs, vectorizer, feature_names):
+    """Apply the max_df, min_df and max_features of vectorizer the way sklearn does.
+    feature_names maps an array of feature indices to their names. Returns the indices and
+    names of the kept features, in alphabetical order"""
+    if len(document_frequencies) == 0:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+    max_doc_count, min_doc_count = document_count_bounds(vectorizer, n_docs)
+    kept = np.flatnonzero((document_frequencies <= max_doc_count) & (document_frequencies >= min_doc_count))
+    names = np.asarray(feature_names(kept), dtype=str)
+    alphabetical_order = np.argsort(names, kind="stable")
+    kept = kept[alphabetical_order]
+    names = names[alphabetical_order]
+    if vectorizer.max_features is not None and len(kept) > vectorizer.max_features:
+        most_frequent = np.sort((-term_frequencies[kept]).argsort()[: vectorizer.max_features])
+        kept = kept[most_frequent]
+        names = names[most_frequent]
+    if len(kept) == 0:
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+    return kept, names
+
+
+def tfidf_transform(counts, vectorizer):
+    """Same weighting as TfidfVectorizer.transform, applied to a count matrix"""
+    tfidf = counts.astype(vectorizer.dtype)
+    if vectorizer.sublinear_tf:
+        np.log(tfidf.data, tfidf.data)
+        tfidf.data += 1.0
+    if vectorizer.use_idf:
+        tfidf.data *= vectorizer.idf_[tfidf.indices]
+    if vectorizer.norm is not None:
+        tfidf = normalize(tfidf, norm=vectorizer.norm, copy=False)
+    return tfidf
+
+
+def fit_vectorizer(vectorizer, vocabulary, counts):
+    """Set the fitted state of vectorizer from its vocabulary and the corpus count matrix,
+    so that it can also transform raw texts. Returns the document-term matrix"""
+    vectorizer.vocabulary_ = {str(name): i for i, name in enumerate(vocabulary)}
+    vectorizer.fixed_vocabulary_ = False
+    if isinstance(vectorizer, TfidfVectorizer):
+        vectorizer.idf_ = (
+            TfidfTransformer(smooth_idf=vectorizer.smooth_idf, sublinear_tf=vectorizer.sublinear_tf).fit(counts).idf_
+        )
+        return tfidf_transform(counts, vectorizer)
+    return counts
+
+
+def select_columns(counts, columns, n_features):
+    """Map count matrix columns onto feature indices, dropping columns mapped to -1"""
+    found = np.flatnonzero(columns >= 0)
+    selector = csr_matrix(
+        (np.ones(len(found), dtype=counts.dtype), (found, columns[found])), shape=(counts.shape[1], n_features)
+    )
+    return (counts @ selector).tocsr()
+
+
+def fit_transform_token_ids(vectorizer, texts):
+    """Equivalent of vectorizer.fit_transform over texts stored as token segments"""
+    vocabulary = shared_vocabulary(texts)
+    stream, lengths = token_stream(texts, vocabulary)
+    keys = []
+    counts = []
+    key_lengths = []
+    for n in range(vectorizer.ngram_range[0], vectorizer.ngram_range[1] + 1):
+        ngram_keys_n, counts_n = ngram_counts(stream, lengths, len(vocabulary), n, vectorizer.dtype)
+        keys.append(ngram_keys_n)
+        counts.append(counts_n)
+        key_lengths.append(np.full(len(ngram_keys_n), n))
+    keys = np.concatenate(keys)
+    key_lengths = np.concatenate(key_lengths)
+    counts = hstack(counts, format="csr")
+    document_frequencies = np.bincount(counts.indices, minlength=counts.shape[1])
+    term_frequencies = np.asarray(counts.sum(axis=0)).ravel()
+
+    def feature_names(indices):
+        names = np.zeros(len(indices), dtype=object)
+        for n in np.unique(key_lengths[indices]):
+            ngram_indices = indices[key_lengths[indices] == n]
+            names[key_lengths[indices] == n] = ngram_names(keys[ngram_indices], vocabulary, n)
+        return names.astype(str)
+
+    kept, names = prune_features(document_frequencies, term_frequencies, len(lengths), vectorizer, feature_names)
+    columns = np.full(counts.shape[1], -1, dtype=np.int64)
+    columns[kept] = np.arange(len(kept))
+    counts = select_columns(counts, columns, len(kept))
+    return fit_vectorizer(vectorizer, names, counts)
+
+
+def transform_token_ids(vectorizer, texts):
+    """Equivalent of vectorizer.transform over texts stored as token segments, for a fitted vectorizer"""
+    vocabulary = shared_vocabulary(texts)
+    stream, lengths = token_stream(texts, vocabulary)
+    feature_names = np.array(sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get), dtype=str)
+    feature_lengths = np.char.count(feature_names, " ") + 1
+    counts = csr_matrix((len(lengths), len(feature_names)), dtype=vectorizer.dtype)
+    for n in range(vectorizer.ngram_range[0], vectorizer.ngram_range[1] + 1):
+        features = np.flatnonzero(feature_lengths == n)
+        unique_keys, counts_n = ngram_counts(stream, lengths, len(vocabulary), n, vectorizer.dtype)
+        feature_keys = ngram_keys(feature_names[features], vocabulary)
+        key_positions = np.minimum(np.searchsorted(unique_keys, feature_keys), max(len(unique_keys) - 1, 0))
+        found = (feature_keys >= 0) & (len(unique_keys) > 0)
+        found[found] = unique_keys[key_positions[found]] == feature_keys[found]
+        columns = np.full(len(unique_keys), -1, dtype=np.int64)
+        columns[key_positions[found]] = features[found]
+        counts = counts + select_columns(counts_n, columns, len(feature_names))
+    if isinstance(vectorizer, TfidfVectorizer):
+        return tfidf_transform(counts, vectorizer)
+    return counts
+
+
+def shard_bounds(n_docs, shards):
+    bounds = np.linspace(0, n_docs, shards + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def count_vectorizer_like(vectorizer, **params):
+    """CountVectorizer with the same text analysis as vectorizer"""
+    count_params = CountVectorizer().get_params()
+    return CountVectorizer(
+        **{**{key: value for key, value in vectorizer.get_params().items() if key in count_params}, **params}
+    )
+
+
+def count_shard(shard):
+    """Count all features of a range of texts. Returns the sorted feature names,
+    the count matrix, and document and term frequencies of each feature"""
+    vectorizer, texts, start, stop = shard
+    counter = count_vectorizer_like(vectorizer, max_df=1.0, min_df=1, max_features=None)
+    try:
+        counts = counter.fit_transform(texts.iterate(start, stop))
+    except ValueError:  # shard has no features
+        return np.zeros(0, dtype=str), csr_matrix((stop - start, 0), dtype=vectorizer.dtype), np.zeros(0), np.zeros(0)
+    document_frequencies = np.bincount(counts.indices, minlength=counts.shape[1])
+    term_frequencies = np.asarray(counts.sum(axis=0)).ravel()
+    return counter.get_feature_names_out().astype(str), counts, document_frequencies, term_frequencies
+
+
+def transform_shard(shard):
+    vectorizer, texts, start, stop = shard
+    counter = count_vectorizer_like(vectorizer, vocabulary=vectorizer.vocabulary_)
+    return counter.transform(texts.iterate(start, stop))
+
+
+def fit_transform_sharded(vectorizer, texts, workers):
+    """Equivalent of vectorizer.fit_transform over texts, counted in parallel shards.
+    Shard vocabularies and frequencies are merged before pruning, and only the kept
+    columns of each shard are stacked into the final matrix."""
+    shards = [(vectorizer, texts, start, stop) for start, stop in shard_bounds(len(texts), workers)]
+    with Pool(workers) as pool:
+        shard_counts = pool.map(count_shard, shards)
+    vocabulary = np.unique(np.concatenate([feature_names for feature_names, _, _, _ in shard_counts]))
+    document_frequencies = np.zeros(len(vocabulary), dtype=np.int64)
+    term_frequencies = np.zeros(len(vocabulary), dtype=vectorizer.dtype)
+    for feature_names, _, shard_document_frequencies, shard_term_frequencies in shard_counts:
+        features = np.searchsorted(vocabulary, feature_names)
+        document_frequencies[features] += shard_document_frequencies.astype(np.int64)
+        term_frequencies[features] += shard_term_frequencies.astype(vectorizer.dtype)
+    kept, names = prune_features(
+        document_frequencies, term_frequencies, len(texts), vectorizer, lambda indices: vocabulary[indices]
+    )
+    columns = np.full(len(vocabulary), -1, dtype=np.int64)
+    columns[kept] = np.arange(len(kept))
+    counts = vstack(
+        [
+            select_columns(shard_matrix, columns[np.searchsorted(vocabulary, feature_names)], len(kept))
+            for feature_names, shard_matrix, _, _ in shard_counts
+        ],
+        format="csr",
+    )
+    return fit_vectorizer(vectorizer, names, counts)
+
+
+def transform_sharded(vectorizer, texts, workers):
+    """Equivalent of vectorizer.transform over texts, transformed in parallel shards"""
+    shards = [(vectorizer, texts, start, stop) for start, stop in shard_bounds(len(texts), workers)]
+    with Pool(workers) as pool:
+        counts = vstack(pool.map(transform_shard, shards), format="csr")
+    if isinstance(vectorizer, TfidfVectorizer):
+        return tfidf_transform(counts, vectorizer)
+    return counts
+
+
+def write_frequency_run(frequencies, run_path):
+    """Spill feature frequencies to disk as a run sorted by feature"""
+    with tempfile.NamedTemporaryFile("w", dir=run_path, encoding="utf-8", delete=False) as run:
+        for feature in sorted(frequencies):
+            document_frequency, term_frequency = frequencies[feature]
+            run.write(f"{feature}\t{document_frequency}\t{term_frequency}\n")
+    return run.name
+
+
+def read_frequency_run(run_file):
+    with open(run_file, encoding="utf-8") as run:
+        for line in run:
+            feature, document_frequency, term_frequency = line.rstrip("\n").split("\t")
+            yield feature, int(document_frequency), int(term_frequency)
+
+
+def count_frequencies(vectorizer, texts, run_path, max_terms_in_memory):
+    """First streaming pass: document and term frequencies of every feature, merged from sorted runs
+    on disk. At most max_terms_in_memory features are held in memory at once. Yields
+    (feature, document frequency, term frequency) in alphabetical order"""
+    analyze = vectorizer.build_analyzer()
+    frequencies = {}
+    runs = []
+    for text in texts:
+        for feature, count in Counter(analyze(text)).items():
+            if feature in frequencies:
+                frequencies[feature][0] += 1
+                frequencies[feature][1] += count
+            else:
+                frequencies[feature] = [1, count]
+        if len(frequencies) >= max_terms_in_memory:
+            runs.append(write_frequency_run(frequencies, run_path))
+            frequencies = {}
+    if frequencies:
+        runs.append(write_frequency_run(frequencies, run_path))
+        frequencies = {}
+    current_feature = None
+    document_frequency = term_frequency = 0
+    for feature, run_document_frequency, run_term_frequency in heapq.merge(
+        *[read_frequency_run(run) for run in runs]
+    ):
+        if feature != current_feature:
+            if current_feature is not None:
+                yield current_feature, document_frequency, term_frequency
+            current_feature = feature
+            document_frequency = term_frequency = 0
+        document_frequency += run_document_frequency
+        term_frequency += run_term_frequency
+    if current_feature is not None:
+        yield current_feature, document_frequency, term_frequency
+
+
+def prune_feature_stream(frequencies, n_docs, vectorizer):
+    """prune_features over an alphabetical stream of (feature, document frequency, term frequency).
+    Only kept features are held in memory: with max_features, a heap of the most frequent ones,
+    ties going to the feature that comes first alphabetically"""
+    max_doc_count, min_doc_count = document_count_bounds(vectorizer, n_docs)
+    kept = []
+    seen_features = False
+    for position, (feature, document_frequency, term_frequency) in enumerate(frequencies):
+        seen_features = True
+        if document_frequency > max_doc_count or document_frequency < min_doc_count:
+            continue
+        if vectorizer.max_features is None:
+            kept.append(feature)
+        elif len(kept) < vectorizer.max_features:
+            heapq.heappush(kept, (term_frequency, -position, feature))
+        else:
+            heapq.heappushpop(kept, (term_frequency, -position, feature))
+    if seen_features is False:
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+    if vectorizer.max_features is not None:
+        kept = sorted(feature for _, _, feature in kept)
+    if len(kept) == 0:
+        raise ValueError("After pruning, no terms remain. Try a lower min_df or a higher max_df.")
+    return np.array(kept, dtype=str)
+
+
+def fit_transform_streaming(vectorizer, texts, workers=1, max_terms_in_memory=5000000, chunk_size=10000):
+    """Equivalent of vectorizer.fit_transform over texts in two passes with bounded memory.
+    Pass one computes exact feature frequencies with sorted runs spilled to disk and prunes
+    the vocabulary. Pass two counts kept features only and assembles the matrix chunk by chunk"""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.normpath(texts.text_path))) as run_path:
+        vocabulary = prune_feature_stream(
+            count_frequencies(vectorizer, texts, run_path, max_terms_in_memory), len(texts), vectorizer
+        )
+    vectorizer.vocabulary_ = {str(name): i for i, name in enumerate(vocabulary)}
+    shard_count = max(workers, len(texts) // chunk_size + 1)
+    shards = [(vectorizer, texts, start, stop) for start, stop in shard_bounds(len(texts), shard_count)]
+    if workers > 1:
+        with Pool(workers) as pool:
+            counts = vstack(pool.map(transform_shard, shards), format="csr")
+    else:
+        counts = vstack([transform_shard(shard) for shard in shards], format="csr")
+    return fit_vectorizer(vectorizer, vocabulary, counts)